@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+DSP benchmarks, run with: python bench.py
+
+Uses synthetic IQ so no SDR is needed. Results are compared against the
+JSON baseline (bench_baseline.json by default) and the run fails if any
+metric is more than --tolerance worse, --update writes a new baseline
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import msgpack
+import numpy as np
+
+import dsp_handler as DSP
+import fft_backend
+import sim_sdr
+
+
+def _format_samps_ref(samp):
+	"""Strided float conversion that format_samps used before the lookup table"""
+	samp_iq = np.frombuffer(samp, dtype=np.uint8)
+
+	samp_out_I = samp_iq[0::2]
+	samp_out_Q = samp_iq[1::2]
+
+	samp_out_I = (samp_out_I.astype(np.float32) - 128) / 128.0
+	samp_out_Q = (samp_out_Q.astype(np.float32) - 128) / 128.0
+
+	return samp_out_I + 1j * samp_out_Q
+
+
+def synth_iq_bytes(num_samps, seed=0):
+	"""Random uint8 IQ bytes, num_samps complex samples long"""
+	rng = np.random.default_rng(seed)
+	return rng.integers(0, 256, num_samps * 2, dtype=np.uint8).tobytes()
+
+
+def timeit(func, repeat=20):
+	"""Returns the best of repeat runs in seconds"""
+	best = float("inf")
+	for _ in range(repeat):
+		start = time.perf_counter()
+		func()
+		best = min(best, time.perf_counter() - start)
+	return best
+
+
+def metric(value, unit, better="higher"):
+	return {"value": float(value), "unit": unit, "better": better}
+
+
+async def timeit_async(make_coro, repeat=20):
+	"""timeit for coroutines, all runs share one event loop, the first is a warmup"""
+	await make_coro()
+	best = float("inf")
+	for _ in range(repeat):
+		start = time.perf_counter()
+		await make_coro()
+		best = min(best, time.perf_counter() - start)
+	return best
+
+
+def bench_iq_conversion(sizes=(16384, 262144, 2048000)):
+	print("[*] IQ conversion (uint8 -> complex)")
+	print(f"{'samples':>10} {'format_samps ref':>18} {'iq_to_complex':>15} {'format_samps':>14} {'out= speedup':>13} {'alloc speedup':>14}")
+
+	results = {}
+
+	for n in sizes:
+		raw = synth_iq_bytes(n)
+		out = np.empty(n, dtype=np.complex64)
+
+		ref = timeit(lambda: _format_samps_ref(raw))
+		lut = timeit(lambda: DSP.iq_to_complex(raw, out=out))
+		fmt = timeit(lambda: DSP.format_samps(raw))
+
+		# format_samps allocates its output like the old code did, so it's the fair comparison
+		print(f"{n:>10} {n / ref / 1e6:>13.1f} MS/s {n / lut / 1e6:>10.1f} MS/s {n / fmt / 1e6:>9.1f} MS/s {ref / lut:>12.1f}x {ref / fmt:>13.1f}x")
+
+		results[f"format_samps_{n}"] = metric(n / fmt, "samples/s")
+		results[f"iq_to_complex_{n}"] = metric(n / lut, "samples/s")
+
+	return results
+
+
+SPANS = (10e6, 50e6, 200e6)
+
+
+def sweep_plan(span, sample_rate=2.4e6):
+	return DSP.SweepPlan.build(850e6 - span / 2, 850e6 + span / 2, sample_rate)
+
+
+def plan_fft_sizes(spans=SPANS, sample_rate=2.4e6):
+	"""FFT sizes SweepPlan picks for sweeps of each span"""
+	return sorted({sweep_plan(span, sample_rate).fft_size for span in spans})
+
+
+def replay_sdr(path, sample_rate=2.4e6):
+	"""FileSdr over synthetic IQ that settles instantly, so reads cost a copy and nothing else"""
+	return sim_sdr.FileSdr(path, sample_rate=sample_rate, settle_time=0)
+
+
+def traced_peak(func):
+	"""
+	Peak traced memory (numpy included) during one call of func
+
+	The most that was live at once, not a count of allocations: tracemalloc
+	only sees blocks that are still allocated
+	"""
+	tracemalloc.start()
+	try:
+		func()
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+
+def bench_get_psd(sdr, repeat=20):
+	print("[*] get_psd per sweep plan FFT size")
+	print(f"{'fft size':>10} {'per hop':>12} {'samples/s':>14}")
+
+	results = {}
+
+	for span in SPANS:
+		plan = sweep_plan(span)
+		n = plan.fft_size
+		if f"get_psd_{n}" in results:
+			continue
+
+		num_samps = plan.capture[0]
+		out = np.empty(plan.crops[0][1] - plan.crops[0][0], dtype=np.float32)
+		iq_buf = np.empty(num_samps, dtype=np.complex64)
+
+		run = lambda: DSP.get_psd(sdr, plan.hops[0][0], plan.hop_width, 0, spec_size=n, out=out, iq_buf=iq_buf,
+			crop=plan.crops[0], averages=plan.averages, overlap=plan.overlap)
+		run()
+		t = timeit(run, repeat)
+
+		print(f"{n:>10} {t * 1e3:>9.2f} ms {num_samps / t / 1e6:>9.1f} MS/s")
+		results[f"get_psd_{n}"] = metric(num_samps / t, "samples/s")
+
+	return results
+
+
+def bench_psd_loop(sdr, repeat=10):
+	print("[*] psd_loop full sweeps")
+	print(f"{'span':>10} {'hops':>6} {'sweeps/s':>10} {'peak mem':>12}")
+
+	results = {}
+
+	for span in SPANS:
+		plan = sweep_plan(span)
+		t = asyncio.run(timeit_async(lambda: DSP.psd_loop(sdr, plan), repeat))
+		peak = traced_peak(lambda: asyncio.run(DSP.psd_loop(sdr, plan)))
+
+		label = f"{int(span / 1e6)}MHz"
+		print(f"{label:>10} {len(plan.hops):>6} {1 / t:>10.2f} {peak / 1e6:>9.2f} MB")
+
+		results[f"psd_loop_{label}"] = metric(1 / t, "sweeps/s")
+		results[f"psd_loop_{label}_peak_mem"] = metric(peak, "bytes", "lower")
+
+	return results
+
+
+def bench_psd_scan(sdr, bandwidths=(200e3, 2e6), repeat=5):
+	print("[*] psd_scan spectrograms")
+	print(f"{'bandwidth':>10} {'scans/s':>10} {'peak mem':>12}")
+
+	results = {}
+
+	for bandwidth in bandwidths:
+		t = asyncio.run(timeit_async(lambda: DSP.psd_scan(sdr, 850e6, bandwidth), repeat))
+		peak = traced_peak(lambda: asyncio.run(DSP.psd_scan(sdr, 850e6, bandwidth)))
+
+		label = f"{int(bandwidth / 1e3)}kHz"
+		print(f"{label:>10} {1 / t:>10.2f} {peak / 1e6:>9.2f} MB")
+
+		results[f"psd_scan_{label}"] = metric(1 / t, "scans/s")
+		results[f"psd_scan_{label}_peak_mem"] = metric(peak, "bytes", "lower")
+
+	return results
+
+
+def bench_packetization(repeat=20):
+	print("[*] msgpack packetization")
+
+	results = {}
+
+	# a PSD sweep as start_wideband sends it
+	psd = np.random.default_rng(0).uniform(-100, -20, 20000).astype(np.float32)
+	pack_psd = lambda: msgpack.packb({"type": "PSD", "dtype": "float32", "decimation": None, "data": memoryview(psd)}, use_bin_type=True)
+	t = timeit(pack_psd, repeat)
+	print(f"{'PSD sweep':>16} {psd.nbytes / t / 1e6:>9.1f} MB/s")
+	results["pack_psd"] = metric(psd.nbytes / t, "bytes/s")
+
+	# a 2 Msample TDOA capture in capture_tdoa's 100 kB packets
+	capture = memoryview(bytearray(synth_iq_bytes(2000000 * 2)))
+	packet_size = int(1e5)
+
+	def pack_tdoa():
+		for index in range(0, len(capture), packet_size):
+			msgpack.packb({"data": capture[index:index + packet_size]}, use_bin_type=True)
+
+	t = timeit(pack_tdoa, max(1, repeat // 4))
+	print(f"{'TDOA capture':>16} {len(capture) / t / 1e6:>9.1f} MB/s")
+	results["pack_tdoa"] = metric(len(capture) / t, "bytes/s")
+
+	return results
+
+
+def peak_rss():
+	# ru_maxrss is kB on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def compare(results, baseline, tolerance):
+	"""
+	Returns the names of metrics more than tolerance worse than the baseline
+	"""
+
+	print(f"[*] Against baseline (tolerance {tolerance:.0%})")
+
+	regressions = []
+
+	for name, result in results.items():
+		if name not in baseline:
+			continue
+
+		base = baseline[name]["value"]
+		value = result["value"]
+		if not base:
+			continue
+
+		# > 0 is better than the baseline
+		change = (value - base) / base
+		if result["better"] == "lower":
+			change = -change
+
+		status = "ok"
+		if change < -tolerance:
+			status = "REGRESSION"
+			regressions.append(name)
+
+		print(f"{name:>28} {change:>+8.1%} {status}")
+
+	return regressions
+
+
+def bench_fft_backends(stft_rows=512):
+	print("[*] FFT backends")
+	sizes = plan_fft_sizes()
+	names = fft_backend.available_backends()
+
+	print(f"{'size':>12} " + " ".join(f"{name:>12}" for name in names))
+
+	rng = np.random.default_rng(0)
+
+	# single hop transforms at the sweep plan sizes, then a batched psd_scan block
+	cases = [(n, (n,)) for n in sizes] + [(512, (stft_rows, 512))]
+
+	for n, shape in cases:
+		x = (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(np.complex64)
+		axis = -1
+
+		times = []
+		for name in names:
+			backend = fft_backend.set_backend(name)
+			backend.fft(x, axis=axis)
+			times.append(timeit(lambda: backend.fft(x, axis=axis)))
+
+		label = f"{shape[0]}x{n}" if len(shape) > 1 else str(n)
+		print(f"{label:>12} " + " ".join(f"{t * 1e6:>9.1f} us" for t in times))
+
+	fft_backend.set_backend()
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument("--baseline", default="bench_baseline.json")
+	parser.add_argument("--update", action="store_true", help="write the results as the new baseline")
+	parser.add_argument("--tolerance", type=float, default=0.25, help="allowed fractional regression")
+	args = parser.parse_args()
+
+	results = {}
+	results.update(bench_iq_conversion())
+	bench_fft_backends()
+
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, "bench.iq")
+		with open(path, "wb") as f:
+			f.write(synth_iq_bytes(1 << 22))
+
+		sdr = replay_sdr(path)
+		results.update(bench_get_psd(sdr))
+		results.update(bench_psd_loop(sdr))
+		results.update(bench_psd_scan(sdr))
+
+	results.update(bench_packetization())
+	results["peak_rss"] = metric(peak_rss(), "bytes", "lower")
+	print(f"[*] Peak RSS {results['peak_rss']['value'] / 1e6:.1f} MB")
+
+	if args.update or not os.path.exists(args.baseline):
+		with open(args.baseline, "w") as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+		print(f"[*] Wrote baseline {args.baseline}")
+		return 0
+
+	with open(args.baseline, "r") as f:
+		baseline = json.load(f)
+
+	regressions = compare(results, baseline, args.tolerance)
+	if regressions:
+		print(f"[!] {len(regressions)} regressions: {', '.join(regressions)}")
+		return 1
+
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,276 @@
+import os
+import json
+import math
+import bisect
+import numpy as np
+from scipy import signal
+
+import dsp_handler as DSP
+
+
+CALIBRATION_DIR = ".calibration"
+
+# sample rates a sweep can run at, rtl-sdr is stable up to 3.2 Msps
+SAMPLE_RATES = (2.048e6, 2.4e6, 2.56e6, 2.88e6, 3.2e6)
+
+
+class PassbandCalibration:
+	"""
+	Measured passband shape and DC offset of one device at one sample rate
+
+	correction is the dB rolloff of each FFT bin relative to the center of
+	the passband (fftshifted, fft_size bins), subtracting it flattens a hop.
+	usable is the fraction of the sample rate where the rolloff stays
+	within max_correction_db, that's how wide a hop can be
+	"""
+
+	def __init__(self, sample_rate, correction, dc_offset=0j, usable=0.7, fft_size=None):
+		self.sample_rate = float(sample_rate)
+		self.correction = np.asarray(correction, dtype=np.float32)
+		self.dc_offset = complex(dc_offset)
+		self.usable = float(usable)
+		self.fft_size = fft_size or len(self.correction)
+
+		self._curves = {}
+
+	@property
+	def hop_width(self):
+		# whole kHz so hop centers stay integers
+		return int(self.usable * self.sample_rate / 1000) * 1000
+
+	def curve(self, N):
+		"""
+		Returns the correction resampled to an N point FFT, cached per size
+		"""
+
+		if N not in self._curves:
+			src = (np.arange(self.fft_size) - self.fft_size // 2) / self.fft_size
+			dst = (np.arange(N) - N // 2) / N
+			self._curves[N] = np.interp(dst, src, self.correction).astype(np.float32)
+
+		return self._curves[N]
+
+	@classmethod
+	def measure(cls, sdr, freqs, fft_size=4096, averages=64, max_correction_db=6.0,
+			max_usable=0.92, spike_bins=2, deleted_samps=16384):
+		"""
+		Measures the passband with no signal present (antenna off or a quiet band)
+
+		Noise is averaged at each of freqs, so what's left is the shape of
+		the tuner and ADC filters. The DC offset is the mean of the raw IQ
+		"""
+
+		num_samps, step = DSP.capture_size(fft_size, averages, 0.5)
+
+		dc_sum = 0j
+		shapes = []
+
+		for freq in freqs:
+			sdr.center_freq = float(freq)
+			DSP.read_raw(sdr, deleted_samps * 2)
+
+			samples = DSP.read_iq(sdr, num_samps)
+			dc = complex(np.mean(samples))
+			dc_sum += dc
+			samples -= dc
+
+			psd_db = DSP.compute_psd(samples, 0, fft_size, fft_size=fft_size, step=step)
+			shapes.append(psd_db)
+
+		dc_offset = dc_sum / len(freqs)
+		shape = np.median(np.array(shapes), axis=0)
+
+		# median filter keeps the filter edges sharp but drops noise and the DC spike
+		smoothed = signal.medfilt(shape, kernel_size=31)
+
+		center = fft_size // 2
+		# the residual spike is static, so keep it in the correction
+		smoothed[center - spike_bins:center + spike_bins + 1] = shape[center - spike_bins:center + spike_bins + 1]
+
+		reference = np.median(smoothed[center - fft_size // 10:center + fft_size // 10])
+		correction = smoothed - reference
+
+		# widest span around the center that needs no more than max_correction_db
+		outside = np.abs(correction) > max_correction_db
+		outside[center - spike_bins:center + spike_bins + 1] = False
+		half = center
+		for offset in range(1, center):
+			if outside[center - offset] or (center + offset < fft_size and outside[center + offset]):
+				half = offset
+				break
+
+		usable = min(max_usable, (2 * half) / fft_size)
+
+		return cls(sdr.sample_rate, correction, dc_offset=dc_offset, usable=usable, fft_size=fft_size)
+
+	@staticmethod
+	def path(dev_id, sample_rate):
+		return os.path.join(CALIBRATION_DIR, f"dev{dev_id}_{int(sample_rate)}.json")
+
+	def save(self, dev_id):
+		os.makedirs(CALIBRATION_DIR, exist_ok=True)
+
+		with open(self.path(dev_id, self.sample_rate), "w") as f:
+			json.dump({
+				"sample_rate": self.sample_rate,
+				"fft_size": self.fft_size,
+				"dc_offset": [self.dc_offset.real, self.dc_offset.imag],
+				"usable": self.usable,
+				"correction": [round(float(x), 3) for x in self.correction]
+			}, f)
+
+	@classmethod
+	def load(cls, dev_id, sample_rate):
+		"""
+		Returns the saved calibration for a device and sample rate, or None
+		"""
+
+		path = cls.path(dev_id, sample_rate)
+		if not os.path.exists(path):
+			return None
+
+		try:
+			with open(path, "r") as f:
+				data = json.load(f)
+
+			return cls(
+				data["sample_rate"],
+				data["correction"],
+				dc_offset=complex(*data["dc_offset"]),
+				usable=data["usable"],
+				fft_size=data["fft_size"]
+			)
+		except Exception as e:
+			print(f"[!] Bad calibration file {path}: {e}")
+			return None
+
+
+# where the default settle measurement tunes, spread over the R820T's range
+SETTLE_FREQS = (50e6, 100e6, 200e6, 400e6, 600e6, 900e6, 1200e6, 1600e6)
+
+
+class SettleCalibration:
+	"""
+	How many samples the device needs to settle after a retune, per frequency range
+
+	freqs are the measured frequencies and samples the settle at each, at
+	sample_rate. A frequency uses the nearest measurement, so each covers
+	the range halfway to its neighbours
+	"""
+
+	def __init__(self, sample_rate, freqs, samples):
+		order = np.argsort(freqs)
+
+		self.sample_rate = float(sample_rate)
+		self.freqs = [float(freqs[i]) for i in order]
+		self.samples = [int(samples[i]) for i in order]
+
+		# range edges between neighbouring measurements
+		self._edges = [(a + b) / 2 for a, b in zip(self.freqs, self.freqs[1:])]
+
+	def settle(self, freq, sample_rate=None):
+		"""
+		Returns the samples to discard after tuning to freq, scaled to sample_rate
+		"""
+
+		samples = self.samples[bisect.bisect_right(self._edges, freq)]
+
+		if sample_rate and sample_rate != self.sample_rate:
+			# settling is a time, so it scales with the rate
+			samples = int(math.ceil(samples * sample_rate / self.sample_rate))
+
+		return samples
+
+	@staticmethod
+	def settled_at(blocks, tolerance_db):
+		"""
+		Returns the index of the first block after which every block is
+		within tolerance of the second half, blocks are dB rows
+
+		The second half is assumed settled, its own worst deviation is the
+		noise so the tolerance is never tighter than that
+		"""
+
+		half = len(blocks) // 2
+		error = np.max(np.abs(blocks - np.mean(blocks[half:], axis=0)), axis=1)
+
+		tolerance_db = max(tolerance_db, float(np.max(error[half:])))
+		unsettled = np.flatnonzero(error[:half] > tolerance_db)
+
+		return int(unsettled[-1]) + 1 if len(unsettled) else 0
+
+	@classmethod
+	def measure(cls, sdr, freqs=SETTLE_FREQS, step_hz=None, repeats=8, record_samps=65536, block=256,
+			bands=8, tolerance_db=1.0, margin=1.25, min_samps=256):
+		"""
+		Measures the settle at each of freqs by retuning onto it step_hz
+		(a hop, by default) and watching what comes after
+
+		Each read after the retune is cut into block sample blocks, and the
+		power in bands sub-bands of each block is averaged over repeats
+		retunes. The device is settled once every later block's band powers
+		stay within tolerance_db (or the noise, if that's more) of the second
+		half of the read, which catches the DC step and gain ramp as well as
+		the PLL pulling in
+		"""
+
+		step_hz = step_hz or sdr.sample_rate * 0.7
+		n_blocks = record_samps // block
+
+		settles = []
+
+		for freq in freqs:
+			power = np.zeros((n_blocks, bands))
+
+			for _ in range(repeats):
+				# sit on the previous hop long enough to be fully settled there
+				sdr.center_freq = float(freq - step_hz)
+				DSP.read_raw(sdr, record_samps * 2)
+
+				sdr.center_freq = float(freq)
+				x = DSP.read_iq(sdr, n_blocks * block).reshape(n_blocks, block)
+
+				spectra = np.abs(np.fft.fft(x, axis=1)) ** 2
+				power += spectra.reshape(n_blocks, bands, block // bands).mean(axis=2)
+
+			power_db = 10 * np.log10(power / repeats + 1e-20)
+
+			settled = cls.settled_at(power_db, tolerance_db) * block
+			settles.append(max(min_samps, int(math.ceil(settled * margin / block)) * block))
+
+			print(f"[*] Settle at {freq / 1e6:.1f} MHz: {settles[-1]} samples")
+
+		return cls(sdr.sample_rate, list(freqs), settles)
+
+	@staticmethod
+	def path(dev_id):
+		return os.path.join(CALIBRATION_DIR, f"dev{dev_id}_settle.json")
+
+	def save(self, dev_id):
+		os.makedirs(CALIBRATION_DIR, exist_ok=True)
+
+		with open(self.path(dev_id), "w") as f:
+			json.dump({
+				"sample_rate": self.sample_rate,
+				"freqs": self.freqs,
+				"samples": self.samples
+			}, f)
+
+	@classmethod
+	def load(cls, dev_id):
+		"""
+		Returns the saved settle table for a device, or None
+		"""
+
+		path = cls.path(dev_id)
+		if not os.path.exists(path):
+			return None
+
+		try:
+			with open(path, "r") as f:
+				data = json.load(f)
+
+			return cls(data["sample_rate"], data["freqs"], data["samples"])
+		except Exception as e:
+			print(f"[!] Bad settle calibration file {path}: {e}")
+			return None
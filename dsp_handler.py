@@ -1,37 +1,115 @@
 import io
+import os
 import math
+import time
 import asyncio
 import sys
 import base64
+import queue
+import threading
+import weakref
+from dataclasses import dataclass, field
 import numpy as np
-import matplotlib.pyplot as plt
 from PIL import Image
-from rtlsdr import RtlSdr
 from scipy import signal
 
+from fft_backend import get_backend
+import sim_sdr
+import metrics
+
+try:
+	from rtlsdr import RtlSdr
+except ImportError:
+	# librtlsdr isn't installed, only the simulated devices from sim_sdr work
+	RtlSdr = None
+
 
 # TMP remove
 stop_sdr = False
 
 
-def format_samps(samp):
+# samples thrown away after a retune when there's no SettleCalibration
+DEFAULT_SETTLE_SAMPS = 2048
+
+
+# uint8 -> float32 lookup for RTL-SDR IQ bytes, centered on 127.5 so there is no DC bias
+IQ_LUT = (np.arange(256, dtype=np.float32) - 127.5) / 127.5
+
+
+def iq_to_complex(samp, out=None):
+	"""
+	Converts interleaved uint8 IQ bytes to complex64 using IQ_LUT
+
+	Args:
+	samp: bytes, bytearray, memoryview or uint8 array of interleaved IQ
+	out: optional complex64 array to write into, must hold len(samp) // 2 samples
+
+	Returns the complex64 samples (a view of out if given)
+	"""
+
 	samp_iq = np.frombuffer(samp, dtype=np.uint8)
+	n = len(samp_iq) // 2
+
+	if out is None:
+		out = np.empty(n, dtype=np.complex64)
+
+	out = out[:n]
+
+	# complex64 is two float32s, so one table lookup fills I and Q in place.
+	# uint8 indices can't leave the table, and mode="clip" stops numpy buffering out
+	np.take(IQ_LUT, samp_iq[:n * 2], out=out.view(np.float32), mode="clip")
+
+	return out
+
+
+# librtlsdr's synchronous reads are USB bulk transfers, a length that isn't
+# a multiple of this fails
+USB_BLOCK_BYTES = 512
+
+
+def read_raw(sdr, num_bytes):
+	"""
+	Reads num_bytes of uint8 IQ, rounding the USB read up to whole blocks
+
+	Returns a uint8 array of the first num_bytes
+	"""
+
+	num_bytes = int(num_bytes)
+	if num_bytes <= 0:
+		return np.empty(0, dtype=np.uint8)
+
+	aligned = -(-num_bytes // USB_BLOCK_BYTES) * USB_BLOCK_BYTES
+
+	return np.frombuffer(sdr.read_bytes(aligned), dtype=np.uint8)[:num_bytes]
+
 
-	samp_out_I = samp_iq[0::2]
-	samp_out_Q = samp_iq[1::2]
+def read_iq(sdr, num_samps, out=None):
+	"""
+	Reads num_samps from the sdr as complex64 without going through read_samples
+	"""
 
-	samp_out_I = (samp_out_I.astype(np.float32) - 128) / 128.0
-	samp_out_Q = (samp_out_Q.astype(np.float32) - 128) / 128.0
+	return iq_to_complex(read_raw(sdr, num_samps * 2), out=out)
 
-	samp_out = samp_out_I + 1j * samp_out_Q
 
-	return samp_out
+def format_samps(samp):
+	return iq_to_complex(samp)
+
+
+
+async def _ext_capture_process(dev_id, samp_num, freq1, freq2):
+	"""
+	Starts the librtlsdr-2freq rtl_sdr capture writing uint8 IQ to stdout
 
+	With SDR_DEVICE set to a simulated device sim_sdr.py stands in for rtl_sdr
+	"""
 
+	if sim_sdr.is_simulated(os.getenv('SDR_DEVICE')):
+		rtl_sdr = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "sim_sdr.py")]
+	else:
+		rtl_sdr = ["./.librtlsdr-2freq/build/src/rtl_sdr"]
 
-async def read_ext_samples(dev_id, samp_num, freq1, freq2):
 	tdoa_prc_args = [
-			"./.librtlsdr-2freq/build/src/rtl_sdr",
+			*rtl_sdr,
 			"-f", str(freq1),
 			"-h", str(freq2),
 			"-d", str(dev_id),
@@ -51,21 +129,122 @@ async def read_ext_samples(dev_id, samp_num, freq1, freq2):
 	# await asyncio.sleep(delay)
 	# print(f"after delay {datetime.now().timestamp()}")
 
-	process = await asyncio.create_subprocess_exec(
+	return await asyncio.create_subprocess_exec(
 			*prc_args,
 			stdout=asyncio.subprocess.PIPE,
 			stderr=asyncio.subprocess.PIPE
 			)
 
-	samp_out = bytearray()
 
-	while True:
-		chunk = await process.stdout.read(4096)
+async def _end_capture(process):
+	"""
+	Kills the capture if it's still running and reaps it
+
+	Whatever is left in its pipes is read and dropped, a killed child with
+	unread stdout would otherwise leave wait() blocked for good
+	"""
+
+	if process.returncode is None:
+		try:
+			process.kill()
+		except ProcessLookupError:
+			pass
+
+	await process.communicate()
+
+
+async def read_ext_samples(dev_id, samp_num, freq1, freq2, expected_bytes=None, read_size=1 << 20):
+	"""
+	Runs the librtlsdr-2freq capture and reads its output into one buffer
+
+	The buffer is allocated once at expected_bytes (samp_num samples at each
+	of the two frequencies by default) and filled with large reads, so it
+	never grows or reallocates
+
+	Returns a memoryview of the bytes read
+	"""
+
+	process = await _ext_capture_process(dev_id, samp_num, freq1, freq2)
+
+	if expected_bytes is None:
+		expected_bytes = int(samp_num) * 4
+
+	samp_out = bytearray(expected_bytes)
+	view = memoryview(samp_out)
+	filled = 0
+
+	while filled < expected_bytes:
+		chunk = await process.stdout.read(min(read_size, expected_bytes - filled))
 		if not chunk:
 			break
-		samp_out.extend(chunk)
+		view[filled:filled + len(chunk)] = chunk
+		filled += len(chunk)
+
+	# anything past the expected size was dropped before too, _end_capture drains it
+	await _end_capture(process)
+
+	return view[:filled]
+
+
+async def stream_ext_samples(dev_id, samp_num, freq1, freq2, packet_size=int(1e5), expected_bytes=None, max_queued=32):
+	"""
+	Async generator version of read_ext_samples, yields packet_size byte
+	packets as soon as the capture has produced them
+
+	Packets wait in a queue of at most max_queued between the capture and
+	the consumer, if it fills the capture's pipe stops being read
+
+	Yields bytes, the last packet may be short
+	"""
+
+	process = await _ext_capture_process(dev_id, samp_num, freq1, freq2)
+
+	if expected_bytes is None:
+		expected_bytes = int(samp_num) * 4
+
+	packets = asyncio.Queue(maxsize=max_queued)
 
-	return samp_out
+	async def produce():
+		remaining = expected_bytes
+		try:
+			while remaining > 0:
+				try:
+					packet = await process.stdout.readexactly(min(packet_size, remaining))
+				except asyncio.IncompleteReadError as e:
+					# capture ended early, send what there is
+					if e.partial:
+						await packets.put(e.partial)
+					break
+
+				remaining -= len(packet)
+				await packets.put(packet)
+		except asyncio.CancelledError:
+			# the consumer went away, nobody is waiting for the end marker
+			raise
+		except Exception:
+			await packets.put(None)
+			raise
+
+		await packets.put(None)
+
+	producer = asyncio.create_task(produce())
+
+	try:
+		while True:
+			packet = await packets.get()
+			if packet is None:
+				break
+			yield packet
+
+		# raises anything the capture hit
+		await producer
+	finally:
+		if not producer.done():
+			producer.cancel()
+			# stdout can only have one reader, let the producer's read finish cancelling
+			await asyncio.gather(producer, return_exceptions=True)
+
+		await _end_capture(process)
 
 
 def rtl_config(samp_rate, freq_correction=None, device_id: int = 0):
@@ -80,6 +259,8 @@ def rtl_config(samp_rate, freq_correction=None, device_id: int = 0):
 		test = True
 		test = False
 
+	SDR_DEVICE picks a simulated device instead, see sim_sdr.open_device
+
 	Gain values:
 
 	0, 9, 14, 27, 37, 77, 87, 125, 144, 157, 166, 197,
@@ -87,7 +268,14 @@ def rtl_config(samp_rate, freq_correction=None, device_id: int = 0):
 	402, 421, 434, 439, 445, 480, 496
 	"""
 
-	sdr = RtlSdr(device_index=device_id)
+	sdr = sim_sdr.open_device(os.getenv('SDR_DEVICE'), samp_rate, device_id=device_id)
+
+	if sdr is None:
+		if RtlSdr is None:
+			raise RuntimeError("librtlsdr is not installed, set SDR_DEVICE to use a simulated device")
+
+		sdr = RtlSdr(device_index=device_id)
+
 	sdr.sample_rate = samp_rate
 
 	print(f"configured sdr with: {device_id, samp_rate}")
@@ -108,6 +296,9 @@ async def kill_sdr():
 
 
 def _psd_plot(frequencies, psd):
+	# debug only, pyplot is slow to import so keep it out of the node's startup
+	import matplotlib.pyplot as plt
+
 	plt.rcParams['axes.facecolor'] = 'black'
 
 	plt.semilogy(frequencies / 2e6, psd)
@@ -122,158 +313,1165 @@ def next_power_of_2(n):
 
 
 
-def get_psd(sdr, freq, hop, crop_top, spec_size=2, deleted_samps=2048):
+def hop_bins(N, samp_rate, hop, crop_top):
 	"""
-	Gets PSD data at center freq
+	Returns the (start, stop) bins get_psd keeps from an N point hop
+	"""
+
+	# Gets crop % from the part of the samp rate outside the freq hop
+	crop_percent = (1 / samp_rate) * (samp_rate - hop)
+
+	crop_bin = int((crop_percent * N) / 2)
+	top_crop_bin = int((crop_top * (N - (crop_bin * 2))))
+
+	return crop_bin, N - (crop_bin + top_crop_bin)
+
+
+# most samples a sweep hop reads. Each sits in the hop ring, iq_buf and the
+# batched FFT's output at once, about 24 bytes a sample
+MAX_CAPTURE_SAMPS = 1 << 20
+
+
+def capture_size(fft_size, averages=1, overlap=0.5):
+	"""
+	Returns (samples to read, frame step) for averages overlapping frames of fft_size
 	"""
 
-	sdr.center_freq = float(freq)
+	step = max(1, fft_size - int(round(fft_size * overlap)))
 
-	# Subtracts samp rate from freq hop
-	crop_total = sdr.sample_rate - hop
+	return fft_size + (averages - 1) * step, step
 
-	# Gets crop %
-	crop_percent = (1 / sdr.sample_rate) * crop_total
 
-	# sets min spec size
+def get_psd(sdr, freq, hop, crop_top, spec_size=2, deleted_samps=DEFAULT_SETTLE_SAMPS, out=None, iq_buf=None, crop=None, averages=1, overlap=0.5,
+		correction=None, dc_offset=0):
+	"""
+	Gets PSD data at center freq
+
+	If out is given the cropped dB values are written straight into it,
+	it must be hop_bins() long. iq_buf is an optional complex64 buffer
+	of at least capture_size() samples reused for the capture
+
+	crop is a precomputed (start, stop) bin pair from a SweepPlan, with it
+	spec_size is used as the FFT size as is
+
+	averages > 1 reads that many frames, overlapping by overlap, in one
+	read and averages them in linear power (Welch)
+
+	correction and dc_offset come from a passband calibration, see compute_psd
+	"""
+
+	with metrics.stage("retune"):
+		sdr.center_freq = float(freq)
+
 	N = spec_size
-	if N < 1024:
-		N = 1024
 
-	sdr.read_samples(deleted_samps)
-	samples = sdr.read_samples(N)
+	if crop:
+		start_bin, stop_bin = crop
+	else:
+		# sets min spec size
+		if N < 1024:
+			N = 1024
+
+		start_bin, stop_bin = hop_bins(N, sdr.sample_rate, hop, crop_top)
+
+	num_samps, step = capture_size(N, averages, overlap)
+
+	# settle samples are thrown away, so skip converting them
+	with metrics.stage("settle_discard"):
+		read_raw(sdr, deleted_samps * 2)
+
+	with metrics.stage("usb_read"):
+		raw = read_raw(sdr, num_samps * 2)
 
-	normal = True
+	with metrics.stage("convert"):
+		samples = iq_to_complex(raw, out=iq_buf)
 
-	# These will be updated soon, but works well enough for now
-	if normal:
+	# compute_psd crops as it goes, so cropping is part of this stage
+	with metrics.stage("fft"):
+		return compute_psd(samples, start_bin, stop_bin, out=out, fft_size=N, step=step, correction=correction, dc_offset=dc_offset)
 
-		window = signal.windows.hann(N)
-		windowed_samples = samples * window
 
-		fft_res = np.abs(np.fft.fft(windowed_samples))
-		PSD = np.abs(fft_res) ** 2 / (N * np.sum(window ** 2))
+def compute_psd(samples, start_bin, stop_bin, out=None, fft_size=None, step=None, correction=None, dc_offset=0):
+	"""
+	Windowed FFT of a capture, returns the dB values of bins start_bin to stop_bin
+
+	Written into out if given. If samples is longer than fft_size it's
+	split into frames step apart, transformed in one batched FFT and
+	averaged in linear power. samples is modified in place (it's normally
+	the iq_buf scratch buffer)
 
-		PSD_log = 10.0 * np.log10(PSD)
-		PSD_shifted = np.fft.fftshift(PSD_log)
+	dc_offset is subtracted from the samples first and correction, a
+	fftshifted dB curve of fft_size bins, is subtracted from the result
+	"""
 
-		crop_bin = int((crop_percent * len(PSD_shifted)) / 2)
-		top_crop_bin = int((crop_top * (len(PSD_shifted) - (crop_bin * 2))))
+	N = fft_size or len(samples)
+	backend = get_backend()
+	window = backend.window(N)
 
-		psd_cropped = PSD_shifted[crop_bin:-(crop_bin + top_crop_bin)]
+	if dc_offset:
+		samples -= np.complex64(dc_offset)
 
+	if len(samples) > N:
+		frames = np.lib.stride_tricks.sliding_window_view(samples, N)[::step or N]
+		# frames overlap, so windowing makes the one copy the batch needs
+		fft_res = backend.fft(frames * window, axis=1, overwrite_x=True)
 	else:
-		frequencies, psd = signal.welch(
-				samples,
-				fs=sdr.sample_rate,
-				nperseg=N,
-				detrend=False)
+		samples = samples[:N]
+		samples *= window
+		fft_res = backend.fft(samples, overwrite_x=True)[None, :]
 
-		crop_bin = int((crop_percent * len(psd)) / 2)
-		top_crop_bin = int((crop_top * (len(psd) - (crop_bin * 2))))
+	if out is None:
+		out = np.empty(stop_bin - start_bin, dtype=np.float32)
 
-		psd_db = 10 * np.log10(psd + 1e-12)
+	# fftshifted bin k is fft_res[k + (N - N // 2)] below the center and
+	# fft_res[k - N // 2] from it, so only the kept bins are touched
+	half = N // 2
+	split = min(max(half, start_bin), stop_bin)
 
-		crop_bins = int((crop_percent * len(psd_db)) / 2)
-		psd_cropped = psd_db[crop_bin:-(crop_bin + top_crop_bin)]
+	low = slice(start_bin + N - half, split + N - half)
+	high = slice(split - half, stop_bin - half)
 
+	for cols, dest in ((low, out[:split - start_bin]), (high, out[split - start_bin:])):
+		power = np.abs(fft_res[:, cols])
+		np.square(power, out=power)
+		np.mean(power, axis=0, out=dest, dtype=np.float32)
 
-	return psd_cropped
+	out *= 1.0 / backend.window_norm(N)
+	np.log10(out, out=out)
+	out *= 10.0
 
+	if correction is not None:
+		out -= correction[start_bin:stop_bin]
 
+	return out
 
-async def psd_loop(sdr, start_freq: int, stop_freq: int, target_freq, trigger_db, trigger_bw, trigger_active):
 
+def sweep_hops(start_freq, stop_freq, hop_width):
 	"""
-	Takes an SDR class from RtlSdr()
+	Returns a list of (center freq, crop_top, crop_hz) for each hop of a sweep
+	"""
+
+	hops = []
+
+	for i in range(start_freq + int(hop_width / 2), stop_freq + int(hop_width / 2), hop_width):
+		crop_top = 0
+		crop_hz = 0
+		if (i + int(hop_width / 2)) > stop_freq:
+			crop_hz = (i + int(hop_width / 2)) - stop_freq
+			crop_top = (1 / hop_width) * crop_hz
+
+		hops.append((i, crop_top, crop_hz))
+
+	return hops
+
 
-	Returns a freq array of db values
+def fast_fft_size(n):
+	"""
+	Returns the largest 2^a * 3^b * 5^c <= n, sizes numpy's FFT handles efficiently
 	"""
 
-	hop_width = 1700000
-	send_data = True
+	n = max(int(n), 1)
+	best = 1
 
-	psd = np.array([])
-	freq = np.array([])
+	p5 = 1
+	while p5 <= n:
+		p35 = p5
+		while p35 <= n:
+			# largest power of 2 that still fits
+			best = max(best, p35 << ((n // p35).bit_length() - 1))
+			p35 *= 3
+		p5 *= 5
 
-	scan_size = stop_freq - start_freq
-	scan_steps = hop_width / scan_size
+	return best
 
-	spec_size = scan_steps * 2048
-	spec_size = next_power_of_2(spec_size)
 
+@dataclass(frozen=True)
+class SweepPlan:
+	"""
+	Everything psd_loop needs for a sweep, built once per scan settings change
 
+	hops: (center freq, crop_top, crop_hz) for each hop
+	crops: (start, stop) bins kept from each hop's FFT
+	offsets: where each hop's bins start in the sweep output, plus the total
+	discards: samples thrown away after tuning to each hop
+	"""
 
-	if trigger_active:
-		if target_freq and trigger_bw:
-			target_freq = float(target_freq) * 1e6
-			trigger_bw = float(trigger_bw) * 1e6
+	start_freq: int
+	stop_freq: int
+	sample_rate: float
+	hop_width: int
+	fft_size: int
+	hops: tuple
+	crops: tuple
+	offsets: tuple
+	averages: int = 1
+	overlap: float = 0.5
+	# from a PassbandCalibration, the fft_size bin dB correction and IQ DC offset
+	correction: object = field(default=None, compare=False, repr=False)
+	dc_offset: complex = 0j
+	discards: tuple = ()
+
+	@property
+	def total_bins(self):
+		return self.offsets[-1]
+
+	@property
+	def capture(self):
+		"""(samples read per hop, frame step)"""
+		return capture_size(self.fft_size, self.averages, self.overlap)
+
+	@property
+	def bin_hz(self):
+		return self.sample_rate / self.fft_size
+
+	@classmethod
+	def build(cls, start_freq, stop_freq, sample_rate, hop_width=None, max_bins=20000,
+			resolution_hz=None, min_fft=64, max_fft=65536, averages=1, overlap=0.5, calibration=None, settle=None,
+			max_capture=MAX_CAPTURE_SAMPS):
+		"""
+		Plans a sweep whose output fits in max_bins
+
+		The FFT size is the largest efficient size where every kept bin can
+		be shown in max_bins, or the size for resolution_hz if that's coarser.
+		averages and overlap set the Welch averaging of each hop, averages is
+		cut down so a hop's capture stays within max_capture samples
+
+		With a PassbandCalibration for this sample rate the hop width is
+		its usable bandwidth and every hop is flattened with its correction,
+		without one hop_width defaults to the same fraction 1.7 MHz is of 2.4 Msps
+
+		With a SettleCalibration each hop only discards what its frequency
+		needs after the retune, otherwise DEFAULT_SETTLE_SAMPS
+		"""
+
+		start_freq = int(start_freq)
+		stop_freq = int(stop_freq)
+
+		if calibration and calibration.sample_rate != sample_rate:
+			calibration = None
+
+		if calibration:
+			hop_width = calibration.hop_width
+		elif not hop_width:
+			# uncalibrated, keep the 1.7 MHz of 2.4 Msps that's flat enough
+			hop_width = int(sample_rate * (1.7 / 2.4) / 1000) * 1000
+
+		hops = tuple(sweep_hops(start_freq, stop_freq, hop_width))
+
+		# bins each hop keeps are about hop_width / sample_rate of the FFT
+		fft_size = max_bins * sample_rate / (hop_width * max(len(hops), 1))
+		if resolution_hz:
+			fft_size = min(fft_size, sample_rate / resolution_hz)
+
+		fft_size = fast_fft_size(min(max(fft_size, min_fft), max_fft))
+
+		crops = tuple(hop_bins(fft_size, sample_rate, hop_width, crop_top) for freq, crop_top, crop_hz in hops)
+
+		offsets = [0]
+		for start_bin, stop_bin in crops:
+			offsets.append(offsets[-1] + (stop_bin - start_bin))
+
+		if settle:
+			discards = tuple(settle.settle(freq, sample_rate) for freq, crop_top, crop_hz in hops)
+		else:
+			discards = (DEFAULT_SETTLE_SAMPS,) * len(hops)
+
+		overlap = min(max(float(overlap), 0.0), 0.95)
+		step = capture_size(fft_size, 1, overlap)[1]
+		averages = min(max(1, int(averages)), 1 + max(0, int(max_capture) - fft_size) // step)
+
+		return cls(
+			start_freq=start_freq,
+			stop_freq=stop_freq,
+			sample_rate=sample_rate,
+			hop_width=hop_width,
+			fft_size=fft_size,
+			hops=hops,
+			crops=crops,
+			offsets=tuple(offsets),
+			averages=averages,
+			overlap=overlap,
+			correction=calibration.curve(fft_size) if calibration else None,
+			dc_offset=calibration.dc_offset if calibration else 0j,
+			discards=discards
+		)
+
+
+# reused between sweeps so the output isn't reallocated every sweep
+_sweep_buf = None
+
+
+def sweep_buffer(size):
+	"""
+	Returns the shared float32 sweep buffer, only reallocated when the size changes
+	"""
 
-	psd_type = "PSD"
+	global _sweep_buf
 
-	for i in range(start_freq + int(hop_width / 2), stop_freq + int(hop_width / 2), hop_width):
-		if not stop_sdr:
-			crop_top = 0
-			crop_hz = 0
-			if (i + int(hop_width / 2)) > stop_freq:
-				crop_hz = (i + int(hop_width / 2)) - stop_freq
-				crop_top = (1 / hop_width) * crop_hz
-
-			loop = asyncio.get_running_loop()
-			new_psd = await loop.run_in_executor(None, lambda: get_psd(
-				sdr=sdr,
-				spec_size=spec_size,
-				freq=i,
-				hop=hop_width,
-				crop_top=crop_top
-			))
+	if _sweep_buf is None or len(_sweep_buf) != size:
+		_sweep_buf = np.empty(size, dtype=np.float32)
 
-			# check for active trigger
-			if trigger_active:
+	return _sweep_buf
+
+
+
+def mask_runs(mask):
+	"""
+	Returns (starts, stops) arrays of each run of True in a bool array
+	"""
+
+	edges = np.diff(mask.astype(np.int8), prepend=0, append=0)
+
+	return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+class CFARDetector:
+	"""
+	Cell averaging CFAR detector for a PSD in dB
+
+	Each bin's noise level is the mean linear power of train cells either
+	side of it, skipping guard cells next to it. The threshold factor comes
+	from the false alarm rate pfa, so the detector follows the noise floor
+	instead of needing an absolute dB level
+	"""
+
+	def __init__(self, train=16, guard=2, pfa=1e-6):
+		self.train = int(train)
+		self.guard = int(guard)
+		self.pfa = float(pfa)
+
+		# window indices and threshold factors per PSD length
+		self._windows = {}
+
+	def _window(self, n):
+		"""
+		Cumulative sum indices of the training cells and the threshold factor for each of n bins
+		"""
+
+		if n not in self._windows:
+			i = np.arange(n)
+
+			left_lo = np.clip(i - self.guard - self.train, 0, n)
+			left_hi = np.clip(i - self.guard, 0, n)
+			right_lo = np.clip(i + self.guard + 1, 0, n)
+			right_hi = np.clip(i + self.guard + self.train + 1, 0, n)
+
+			# edge bins have fewer training cells, so a higher factor
+			cells = np.maximum((left_hi - left_lo) + (right_hi - right_lo), 1)
+			alpha = cells * (self.pfa ** (-1.0 / cells) - 1)
+
+			self._windows[n] = (left_lo, left_hi, right_lo, right_hi, cells, alpha)
+
+		return self._windows[n]
+
+	def detect(self, psd_db):
+		"""
+		Returns a list of (start bin, stop bin, peak bin, snr dB) for each run of detected bins
+		"""
 
-				trigger_start = target_freq - (trigger_bw / 2)
-				trigger_stop = target_freq + (trigger_bw / 2)
+		n = len(psd_db)
+		left_lo, left_hi, right_lo, right_hi, cells, alpha = self._window(n)
 
-				# lol this sucks
-				if (i - hop_width) < trigger_stop and (i + hop_width) > trigger_start:
-					cropped_hop = hop_width - crop_hz
-					hz_percent = len(new_psd) / cropped_hop
-					scan_start = i - (hop_width / 2)
-					scan_stop = (i + (hop_width / 2)) - crop_hz
+		power = np.power(10.0, np.asarray(psd_db, dtype=np.float64) / 10.0)
 
-					start_diff = int((trigger_start - scan_start) * hz_percent)
-					stop_diff = int((trigger_stop - scan_stop) * hz_percent)
+		cum = np.empty(n + 1)
+		cum[0] = 0
+		np.cumsum(power, out=cum[1:])
 
-					start_bin = start_diff if start_diff >= 0 else None
-					stop_bin = stop_diff if stop_diff < 0 else None
+		noise = cum[left_hi] - cum[left_lo]
+		noise += cum[right_hi]
+		noise -= cum[right_lo]
+		noise /= cells
 
-					triggered = any(x > trigger_db for x in new_psd[start_bin:stop_bin])
+		detected = power > (alpha * noise)
+		if not detected.any():
+			return []
 
-					if triggered:
-						print(f"TRIGGERED: {triggered}")
+		runs = []
+		for start, stop in zip(*mask_runs(detected)):
+			peak = int(start + np.argmax(power[start:stop]))
+			snr = 10.0 * math.log10(power[peak] / noise[peak]) if noise[peak] > 0 else float("inf")
+			runs.append((int(start), int(stop), peak, snr))
 
-						scan_data = await psd_scan(sdr=sdr, center_freq=target_freq, bandwidth=trigger_bw)
+		return runs
 
-						psd_type = "IMG"
-						return scan_data, psd_type
 
-			psd = np.append(psd, new_psd)
+class NoiseBaseline:
+	"""
+	Running per-bin noise floor of consecutive sweeps, for change detection
+
+	mode "ema" is an exponential moving average of the dB values, "median"
+	steps each bin step_db towards the new value (a streaming median
+	approximation that ignores short bursts). Bins more than rise_db over
+	their baseline are flagged and only pull it up at slow_factor of the
+	normal rate, so a new signal doesn't become the baseline straight away
+
+	All buffers are allocated when the sweep layout changes, update() does
+	no allocations unless bins are flagged
+	"""
+
+	def __init__(self, mode="ema", alpha=0.1, step_db=0.5, rise_db=10.0, slow_factor=0.05, warmup=10):
+		if mode not in ("ema", "median"):
+			raise ValueError(f"unknown baseline mode: {mode}")
+
+		self.mode = mode
+		self.alpha = float(alpha)
+		self.step_db = float(step_db)
+		self.rise_db = float(rise_db)
+		self.slow_factor = float(slow_factor)
+		self.warmup = int(warmup)
+
+		self.key = None
+		self.sweeps = 0
+
+		self.baseline = None
+		self._diff = None
+		self._flagged = None
+
+	def reset(self, key, size):
+		self.key = key
+		self.sweeps = 0
+
+		self.baseline = np.zeros(size, dtype=np.float32)
+		self._diff = np.empty(size, dtype=np.float32)
+		self._flagged = np.zeros(size, dtype=bool)
+
+	def update(self, psd, start_freq, stop_freq):
+		"""
+		Folds a sweep into the baseline
+
+		Returns a list of {"freq", "width", "rise"} for each run of flagged
+		bins, empty while warming up. Bin frequencies are spread linearly
+		over start_freq to stop_freq
+		"""
+
+		key = (start_freq, stop_freq, len(psd))
+		if key != self.key:
+			self.reset(key, len(psd))
+
+		if self.sweeps == 0:
+			self.baseline[:] = psd
+			self.sweeps = 1
+			return []
+
+		diff = self._diff
+		flagged = self._flagged
+
+		np.subtract(psd, self.baseline, out=diff)
+		np.greater(diff, self.rise_db, out=flagged)
+
+		if self.mode == "ema":
+			np.multiply(diff, self.alpha, out=diff)
 		else:
-			sdr.close()
-			send_data = False
-			break
+			np.sign(diff, out=diff)
+			np.multiply(diff, self.step_db, out=diff)
+
+		np.multiply(diff, self.slow_factor, out=diff, where=flagged)
+		np.add(self.baseline, diff, out=self.baseline)
+
+		self.sweeps += 1
+
+		if self.sweeps <= self.warmup or not flagged.any():
+			return []
+
+		bin_hz = (stop_freq - start_freq) / len(psd)
+
+		changes = []
+		for start, stop in zip(*mask_runs(flagged)):
+			peak = int(start + np.argmax(psd[start:stop]))
+			changes.append({
+				"freq": start_freq + peak * bin_hz,
+				"width": float((stop - start) * bin_hz),
+				"rise": float(psd[peak] - self.baseline[peak])
+			})
+
+		return changes
+
+
+class PretriggerRing:
+	"""
+	The most recent raw uint8 captures of each watched hop of a SweepPlan
+
+	All depth captures per hop are allocated up front, depth is cut down
+	so the whole ring stays under max_bytes
+	"""
+
+	def __init__(self, plan, hop_indices, depth=32, max_bytes=32 * 1024 * 1024):
+		self.capture_bytes = plan.capture[0] * 2
+
+		per_capture = max(1, len(hop_indices) * self.capture_bytes)
+		self.depth = max(1, min(int(depth), max_bytes // per_capture))
+
+		self._rows = {hop_index: row for row, hop_index in enumerate(hop_indices)}
+		self._count = [0] * len(hop_indices)
+		self.buf = np.empty((len(hop_indices), self.depth, self.capture_bytes), dtype=np.uint8)
+
+	def has(self, hop_index):
+		row = self._rows.get(hop_index)
+		return row is not None and self._count[row] > 0
+
+	def available(self, hop_index):
+		"""
+		Returns how many samples samples(hop_index) would return
+		"""
+
+		row = self._rows.get(hop_index)
+		if row is None:
+			return 0
+
+		return min(self._count[row], self.depth) * self.capture_bytes // 2
+
+	def push(self, hop_index, raw):
+		"""
+		Copies a hop's raw capture in over its oldest one, ignored for unwatched hops
+		"""
+
+		row = self._rows.get(hop_index)
+		if row is None:
+			return
+
+		self.buf[row, self._count[row] % self.depth, :] = raw[:self.capture_bytes]
+		self._count[row] += 1
+
+	def samples(self, hop_index):
+		"""
+		Returns a hop's captures as one uint8 IQ array, oldest first
+		"""
+
+		row = self._rows[hop_index]
+		filled = min(self._count[row], self.depth)
+		newest = self._count[row] % self.depth
+
+		if self._count[row] <= self.depth:
+			return self.buf[row, :filled].reshape(-1)
+
+		return np.concatenate((self.buf[row, newest:], self.buf[row, :newest]), axis=None)
+
+
+# bins either side of each hop's center that CFAR peaks are ignored in
+CFAR_DC_BINS = 3
+
+
+class TriggerEngine:
+	"""
+	Checks hops of a sweep against a list of trigger bands
+
+	triggers is a list of dicts with "freq" and "bw" in Hz and a "db" level.
+	prepare() maps every band onto the bins of each hop once per
+	SweepPlan, after that check() is one vectorized comparison per hop
+
+	With a CFARDetector every hop is run through it instead, a trigger fires
+	when a detection peaks inside its band ("db" is ignored) and all peaks
+	of the sweep are kept in peaks as {"freq", "snr", "width"} dicts
+
+	pretrigger_depth > 0 keeps up to that many recent captures of every hop
+	that overlaps a band in a PretriggerRing, so a trigger can be imaged
+	from the samples that fired it. Never more than a full size psd_scan
+	image of the narrowest band uses, or than fit in pretrigger_max_bytes
+	"""
+
+	def __init__(self, triggers, detector=None, pretrigger_depth=0, pretrigger_max_bytes=32 * 1024 * 1024):
+		self.triggers = list(triggers)
+		self.detector = detector
+		self.peaks = []
+
+		self.pretrigger_depth = pretrigger_depth
+		self.pretrigger_max_bytes = pretrigger_max_bytes
+		self.pretrigger = None
+
+		self._plan = None
+		self._thresh = None
+		self._hit = None
+		self._offsets = []
+		self._ranges = []
+		self._first_bins_hz = []
+		self._dc_bins = []
+		self._bin_hz = 0
+
+	def prepare(self, plan):
+		"""
+		Builds per-hop thresholds for a SweepPlan, a no-op if it hasn't changed
+
+		Called at the start of every sweep, also clears the last sweep's peaks
+		"""
+
+		self.peaks = []
+
+		if plan is self._plan:
+			return
+
+		offsets = plan.offsets
+		N = plan.fft_size
+
+		# inf where no band is watched so those bins can never fire
+		thresh = np.full(plan.total_bins, np.inf, dtype=np.float32)
+		ranges = []
+		first_bins_hz = []
+		dc_bins = []
+
+		bin_hz = plan.bin_hz
+
+		for hop_index, (freq, crop_top, crop_hz) in enumerate(plan.hops):
+			start_bin, stop_bin = plan.crops[hop_index]
+			hop_len = stop_bin - start_bin
+			hop_thresh = thresh[offsets[hop_index]:offsets[hop_index + 1]]
+
+			# output bin 0 of this hop sits at this offset from the hop center
+			first_bin_hz = (start_bin - N // 2) * bin_hz
+			first_bins_hz.append(freq + first_bin_hz)
+
+			# the tuner's DC spike, CFAR would report it at every hop center
+			dc_bin = N // 2 - start_bin
+			dc_bins.append((max(0, dc_bin - CFAR_DC_BINS), min(hop_len, dc_bin + CFAR_DC_BINS + 1)))
+
+			hop_ranges = []
+			for trigger_index, trigger in enumerate(self.triggers):
+				band_start = trigger["freq"] - (trigger["bw"] / 2) - freq
+				band_stop = trigger["freq"] + (trigger["bw"] / 2) - freq
+
+				lo = max(0, math.ceil((band_start - first_bin_hz) / bin_hz))
+				hi = min(hop_len, math.floor((band_stop - first_bin_hz) / bin_hz) + 1)
+
+				if lo >= hi:
+					# no bin center inside the band, watch the bins its edges fall in
+					lo = max(0, math.floor((band_start - first_bin_hz) / bin_hz + 0.5))
+					hi = min(hop_len, math.floor((band_stop - first_bin_hz) / bin_hz + 0.5) + 1)
+
+				if lo < hi:
+					np.minimum(hop_thresh[lo:hi], trigger["db"], out=hop_thresh[lo:hi])
+					hop_ranges.append((lo, hi, trigger_index))
+
+			ranges.append(hop_ranges)
+
+		self._thresh = thresh
+		self._hit = np.empty(plan.total_bins, dtype=bool)
+		self._offsets = offsets
+		self._ranges = ranges
+		self._first_bins_hz = first_bins_hz
+		self._dc_bins = dc_bins
+		self._bin_hz = bin_hz
+		self._plan = plan
+
+		watched = [hop_index for hop_index, hop_ranges in enumerate(ranges) if hop_ranges]
+		self.pretrigger = None
+		if self.pretrigger_depth and watched:
+			needed = max(scan_samples(trigger["bw"], plan.sample_rate) for trigger in self.triggers)
+			# captures past a full size image would never be looked at
+			depth = min(self.pretrigger_depth, math.ceil(needed / plan.capture[0]))
+			self.pretrigger = PretriggerRing(plan, watched, depth=depth, max_bytes=self.pretrigger_max_bytes)
+
+	def check(self, hop_index, hop_psd):
+		"""
+		Returns the first trigger that fired in this hop or None
+		"""
+
+		hop_ranges = self._ranges[hop_index]
+
+		if self.detector:
+			return self._check_cfar(hop_index, hop_psd, hop_ranges)
+
+		if not hop_ranges:
+			return None
+
+		start = self._offsets[hop_index]
+		hit = self._hit[start:start + len(hop_psd)]
+
+		if not np.greater(hop_psd, self._thresh[start:start + len(hop_psd)], out=hit).any():
+			return None
+
+		# a bin over the combined threshold, find whose band it was in
+		for lo, hi, trigger_index in hop_ranges:
+			trigger = self.triggers[trigger_index]
+			if (hop_psd[lo:hi] > trigger["db"]).any():
+				return trigger
+
+		return None
+
+	def _check_cfar(self, hop_index, hop_psd, hop_ranges):
+		fired = None
+		dc_lo, dc_hi = self._dc_bins[hop_index]
+
+		for start, stop, peak, snr in self.detector.detect(hop_psd):
+			if dc_lo <= peak < dc_hi:
+				continue
+
+			self.peaks.append({
+				"freq": self._first_bins_hz[hop_index] + peak * self._bin_hz,
+				"snr": snr,
+				"width": (stop - start) * self._bin_hz
+			})
+
+			for lo, hi, trigger_index in hop_ranges:
+				if fired is None and lo <= peak < hi:
+					fired = self.triggers[trigger_index]
+
+		return fired
+
+
+# bytes per pyrtlsdr async callback, librtlsdr wants a multiple of 512
+STREAM_BLOCK_SIZE = 1 << 16
+
+
+def stream_bytes(sdr, num_bytes, out=None, block_size=STREAM_BLOCK_SIZE):
+	"""
+	Reads num_bytes of uint8 IQ with pyrtlsdr's streaming interface (read_bytes_async)
+
+	librtlsdr keeps its USB transfers queued while the callback copies each
+	block into out, so nothing is lost between blocks the way it can be
+	between read_bytes calls. Devices without read_bytes_async get one
+	read_bytes
+
+	Returns out (allocated if not given) trimmed to the bytes read
+	"""
+
+	if out is None:
+		out = np.empty(num_bytes, dtype=np.uint8)
+
+	if not hasattr(sdr, "read_bytes_async"):
+		raw = read_raw(sdr, num_bytes)
+		out[:len(raw)] = raw
+		return out[:len(raw)]
+
+	filled = 0
+
+	def on_block(values, context):
+		nonlocal filled
+
+		# librtlsdr can call back again after a cancel
+		if filled >= num_bytes:
+			return
+
+		block = np.frombuffer(values, dtype=np.uint8)
+		n = min(len(block), num_bytes - filled)
+		out[filled:filled + n] = block[:n]
+		filled += n
+
+		if filled >= num_bytes:
+			sdr.cancel_read_async()
+
+	sdr.read_bytes_async(on_block, block_size)
+
+	return out[:filled]
+
+
+class DeviceWorker:
+	"""
+	The one thread that talks to an SDR
+
+	Every blocking device call (tuning, reads, calibration) is a job on the
+	device's worker instead of the default executor, so device work never
+	queues behind unrelated jobs and always runs on the same thread. The
+	worker also owns the device's reusable buffers. Get it with device_worker()
+	"""
+
+	def __init__(self, name="sdr"):
+		self._jobs = queue.Queue()
+		self._buffers = {}
+
+		self._thread = threading.Thread(target=self._run, name=f"{name}-worker", daemon=True)
+		self._thread.start()
+
+	def _run(self):
+		while True:
+			job = self._jobs.get()
+			if job is None:
+				return
+
+			func, args, future, loop = job
+			try:
+				result, error = func(*args), None
+			except Exception as e:
+				result, error = None, e
+
+			loop.call_soon_threadsafe(self._resolve, future, result, error)
+
+	@staticmethod
+	def _resolve(future, result, error):
+		if future.cancelled():
+			return
+
+		if error is not None:
+			future.set_exception(error)
+		else:
+			future.set_result(result)
+
+	def submit(self, func, *args):
+		"""
+		Queues func(*args) on the worker, returns an asyncio future for its result
+		"""
+
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		self._jobs.put((func, args, future, loop))
+
+		return future
+
+	async def call(self, func, *args):
+		"""
+		Runs func(*args) on the worker and returns its result
+		"""
+
+		return await self.submit(func, *args)
+
+	def buffer(self, name, shape, dtype=np.uint8):
+		"""
+		Returns the device's buffer called name, only reallocated when the shape changes
+		"""
+
+		shape = tuple(np.atleast_1d(shape))
+		buf = self._buffers.get(name)
+
+		if buf is None or buf.shape != shape or buf.dtype != dtype:
+			buf = self._buffers[name] = np.empty(shape, dtype=dtype)
+
+		return buf
+
+	def close(self):
+		"""
+		Stops the thread once the jobs already queued are done
+		"""
+
+		self._jobs.put(None)
+
+
+_workers = weakref.WeakKeyDictionary()
+
+
+def device_worker(sdr):
+	"""
+	Returns the DeviceWorker for sdr, started on first use
+	"""
+
+	worker = _workers.get(sdr)
+	if worker is None:
+		worker = _workers[sdr] = DeviceWorker()
+
+	return worker
+
+
+def close_device(sdr):
+	"""
+	Stops the device's worker and closes it, use instead of sdr.close()
+	"""
+
+	worker = _workers.pop(sdr, None)
+	if worker:
+		worker.close()
+
+	sdr.close()
+
+
+# hop captures this short are computed on the event loop, about a quarter millisecond
+INLINE_HOP_SAMPS = 16384
+
+
+class HopAcquirer:
+	"""
+	Tunes and reads the hops of a SweepPlan as a job on the device's worker
+
+	Raw IQ goes into a ring of depth uint8 buffers owned by the worker, so
+	they are reused from sweep to sweep. Filled slots reach the event loop
+	through an asyncio queue and compute_next() runs each one's DSP in the
+	default executor (inline for hops up to INLINE_HOP_SAMPS), so the loop
+	stays free for signaling and the data channel. A slot is only reused once it has been converted, so the
+	reader never gets more than depth hops ahead of the FFT work. With
+	librtlsdr and numpy's FFT both releasing the GIL, reading hop k+1
+	overlaps hop k's DSP
+
+	Hops use blocking reads rather than streaming ones. After a retune the
+	transfers librtlsdr already has queued still hold the previous hop
+
+	Each hop discards plan.discards samples after its retune, unless
+	deleted_samps overrides them
+	"""
+
+	def __init__(self, sdr, plan, depth=3, deleted_samps=None):
+		self.sdr = sdr
+		self.plan = plan
+		self.deleted_samps = deleted_samps
+
+		self.worker = device_worker(sdr)
+		self.ring = self.worker.buffer("hop_ring", (depth, plan.capture[0] * 2))
+
+		self._free = queue.Queue()
+		for slot in range(depth):
+			self._free.put(slot)
+
+		self._filled = None
+		self._loop = None
+		self._job = None
+		self._stop = threading.Event()
+
+	def start(self):
+		self._loop = asyncio.get_running_loop()
+		self._filled = asyncio.Queue()
+		self._job = self.worker.submit(self._run)
+
+	async def stop(self):
+		"""
+		Stops reading and waits for the job, the sdr is free again after this
+		"""
+
+		if self._job is None:
+			return
+
+		self._stop.set()
+		# wakes the job if it's waiting on a free slot
+		self._free.put(None)
+		await self._job
+
+		# and anything still waiting in compute_next
+		self._filled.put_nowait((None, RuntimeError("acquisition stopped")))
+
+	def _post(self, item):
+		self._loop.call_soon_threadsafe(self._filled.put_nowait, item)
+
+	def _run(self):
+		n_bytes = self.ring.shape[1]
+
+		try:
+			for hop_index, (freq, crop_top, crop_hz) in enumerate(self.plan.hops):
+				slot = self._free.get()
+				if slot is None or self._stop.is_set():
+					return
+
+				with metrics.stage("retune"):
+					self.sdr.center_freq = float(freq)
+
+				with metrics.stage("settle_discard"):
+					discard = self.deleted_samps if self.deleted_samps is not None else self.plan.discards[hop_index]
+					read_raw(self.sdr, discard * 2)
+
+				with metrics.stage("usb_read"):
+					# librtlsdr reuses its read buffer, so copy into the ring
+					raw = read_raw(self.sdr, n_bytes)
+					self.ring[slot, :len(raw)] = raw
+
+				self._post((hop_index, slot))
+
+		except Exception as e:
+			self._post((None, e))
+
+	async def compute_next(self, psd, iq_buf, pretrigger=None):
+		"""
+		Waits for the next hop read and computes it into its slice of psd
+
+		The raw capture is also kept in pretrigger (a PretriggerRing) if given
+
+		Returns (hop index, the hop's dB values)
+		"""
+
+		# time the DSP side spends waiting on the reader
+		with metrics.stage("hop_wait"):
+			hop_index, slot = await self._filled.get()
+		if hop_index is None:
+			raise slot
+
+		# a tiny hop costs less than the handoff, and can't hold the loop up for long
+		if self.ring.shape[1] // 2 <= INLINE_HOP_SAMPS:
+			return hop_index, self._compute(hop_index, slot, psd, iq_buf, pretrigger)
+
+		hop_psd = await self._loop.run_in_executor(None, self._compute, hop_index, slot, psd, iq_buf, pretrigger)
+
+		return hop_index, hop_psd
+
+	def _compute(self, hop_index, slot, psd, iq_buf, pretrigger):
+		if pretrigger:
+			pretrigger.push(hop_index, self.ring[slot])
+
+		with metrics.stage("convert"):
+			samples = iq_to_complex(self.ring[slot], out=iq_buf)
+		self._free.put(slot)
+
+		start_bin, stop_bin = self.plan.crops[hop_index]
+		out = psd[self.plan.offsets[hop_index]:self.plan.offsets[hop_index + 1]]
+
+		with metrics.stage("fft"):
+			return compute_psd(
+				samples,
+				start_bin,
+				stop_bin,
+				out=out,
+				fft_size=self.plan.fft_size,
+				step=self.plan.capture[1],
+				correction=self.plan.correction,
+				dc_offset=self.plan.dc_offset
+			)
+
+
+DECIMATION_REDUCERS = ("max", "mean", "minmax")
+
+
+def decimate_psd(psd, max_len, reducer="max"):
+	"""
+	Reduces a sweep of dB values to at most max_len points
+
+	reducer:
+	"max": max hold of each group, narrow signals always survive
+	"mean": mean of each group in linear power
+	"minmax": interleaved (min, max) pairs of each group for envelope drawing
+
+	Returns psd unchanged if it already fits
+	"""
+
+	if reducer not in DECIMATION_REDUCERS:
+		raise ValueError(f"unknown decimation reducer: {reducer}")
+
+	n = len(psd)
+	if n <= max_len:
+		return psd
+
+	groups = max_len // 2 if reducer == "minmax" else max_len
+	factor = math.ceil(n / groups)
+	groups = math.ceil(n / factor)
+
+	# pad the last group by repeating its final value, it doesn't change any reducer
+	padded = np.empty(groups * factor, dtype=np.float32)
+	padded[:n] = psd
+	padded[n:] = psd[-1]
+	grouped = padded.reshape(groups, factor)
+
+	if reducer == "max":
+		return grouped.max(axis=1)
+
+	if reducer == "minmax":
+		out = np.empty((groups, 2), dtype=np.float32)
+		grouped.min(axis=1, out=out[:, 0])
+		grouped.max(axis=1, out=out[:, 1])
+		return out.reshape(-1)
+
+	# mean in linear power, the padding is excluded from the last group
+	np.multiply(padded, np.log(10.0) / 10.0, out=padded)
+	np.exp(padded, out=padded)
+	padded[n:] = 0
+
+	out = grouped.sum(axis=1)
+	out[-1] *= factor / (n - (groups - 1) * factor)
+	out /= factor
+
+	np.log10(out, out=out)
+	out *= 10.0
+
+	return out
+
+
+def pretrigger_samples(sdr, pretrigger, hop_index, hop_freq, post_samples=0, deleted_samps=DEFAULT_SETTLE_SAMPS):
+	"""
+	Returns a hop's pre-trigger captures as uint8 IQ, extended with
+	post_samples read at the same tuning
+	"""
+
+	samps = pretrigger.samples(hop_index)
+
+	if post_samples:
+		sdr.center_freq = float(hop_freq)
+		read_raw(sdr, deleted_samps * 2)
+		post = read_raw(sdr, int(post_samples) * 2)
+		samps = np.concatenate((samps, post))
+
+	return samps
+
+
+async def psd_loop(sdr, plan, trigger_engine=None, dynamic_range=None, img_format="png", reducer="max", max_len=20000, pipeline_depth=3,
+		post_trigger_samples=0):
+
+	"""
+	Takes an SDR class from RtlSdr() and runs one sweep of a SweepPlan
+
+	If a TriggerEngine is given every hop is checked against it and the
+	first trigger to fire returns a spectrogram image instead. With a
+	pretrigger ring the image is made from the hop's recent captures plus
+	post_trigger_samples read after the trigger
+
+	Hops are read by a HopAcquirer on the device's worker, running up to
+	pipeline_depth hops ahead of the FFT work. Sweeps over max_len bins are
+	decimated with reducer, see decimate_psd
+
+	Returns a float32 array of db values, this is the shared sweep buffer
+	(or a view of it) so it must be sent before the next sweep starts
+	"""
+
+	send_data = True
+
+	psd = sweep_buffer(plan.total_bins)
+
+	worker = device_worker(sdr)
+	iq_buf = worker.buffer("hop_iq", plan.capture[0], dtype=np.complex64)
+
+	pretrigger = None
+	if trigger_engine:
+		trigger_engine.prepare(plan)
+		pretrigger = trigger_engine.pretrigger
+
+	psd_type = "PSD"
+
+	acquirer = HopAcquirer(sdr, plan, depth=pipeline_depth)
+	sweep_start = time.perf_counter()
+	acquirer.start()
+
+	try:
+		for _ in plan.hops:
+			if stop_sdr:
+				await acquirer.stop()
+				close_device(sdr)
+				send_data = False
+				break
+
+			# each hop's DSP runs in the executor as its read arrives
+			hop_index, new_psd = await acquirer.compute_next(psd, iq_buf, pretrigger)
+
+			# check for active trigger
+			if trigger_engine:
+				with metrics.stage("trigger_check"):
+					trigger = trigger_engine.check(hop_index, new_psd)
+
+				if trigger:
+					print(f"TRIGGERED: {trigger}")
+
+					# psd_scan needs the sdr to itself
+					await acquirer.stop()
+
+					samps = None
+					hop_freq = plan.hops[hop_index][0]
+
+					# image the captures that fired it rather than retuning and waiting,
+					# psd_scan shrinks the image to what they fill. Too few for a
+					# readable image and a live capture is taken instead
+					available = pretrigger.available(hop_index) + post_trigger_samples if pretrigger else 0
+					if scan_rows(available, trigger["bw"], plan.sample_rate) >= MIN_SCAN_ROWS:
+						samps = await worker.call(
+							pretrigger_samples,
+							sdr, pretrigger, hop_index, hop_freq, post_trigger_samples, plan.discards[hop_index]
+						)
+
+					scan_data = await psd_scan(
+							sdr=sdr,
+							center_freq=trigger["freq"],
+							bandwidth=trigger["bw"],
+							samps=samps,
+							sample_rate=plan.sample_rate,
+							samps_freq=hop_freq,
+							dynamic_range=dynamic_range,
+							img_format=img_format,
+							deleted_samps=plan.discards[hop_index]
+						)
+
+					psd_type = "IMG"
+					return scan_data, psd_type
+	finally:
+		await acquirer.stop()
 
 	if send_data:
-		psd_list = list(psd)
-		psd_len = len(psd_list)
-		max_len = 20000
+		# keep under max canvas width
+		with metrics.stage("decimate"):
+			psd = decimate_psd(psd, max_len, reducer=reducer)
 
-		if psd_len >= max_len:
-			crop = math.ceil(psd_len / max_len)
-			# naive crop to keep under max canvas width TODO replace with averaging
-			psd_list = [psd_list[i] for i in range(len(psd_list)) if i % int(crop) == 0]
+		sweep_time = time.perf_counter() - sweep_start
+		metrics.STAGE_SECONDS.observe(sweep_time, "sweep")
+		metrics.SWEEPS.inc()
+		metrics.SWEEP_RATE.set(1 / sweep_time if sweep_time > 0 else 0)
 
-		return psd_list, psd_type
+		return psd, psd_type
 
 
 def convert_image_to_base64(image_buf):
@@ -287,57 +1485,276 @@ def convert_image_to_base64(image_buf):
 	return base64_encoded
 
 
-async def psd_scan(sdr, center_freq, bandwidth, samps=None):
+# max complex values per batched FFT call in stft_rows, keeps memory bounded on narrow scans
+STFT_BATCH_SIZE = 1 << 21
+
+
+def stft_rows(x, fft_size, hop, num_rows, keep_bins, out=None):
+	"""
+	Batched STFT keeping the center keep_bins of each row in dB
+
+	Frames are a strided view of x (no copies), FFT'd in as few 2-D calls
+	as memory allows. Rows with no full frame left are set to NaN, so
+	render_spectrogram leaves them out of the autoscale
+
+	Returns a (num_rows, keep_bins) float32 array
+	"""
+
+	if out is None:
+		out = np.empty((num_rows, keep_bins), dtype=np.float32)
+
+	n_frames = 0
+	if len(x) >= fft_size:
+		n_frames = min(num_rows, (len(x) - fft_size) // hop + 1)
+
+	out[n_frames:] = np.nan
+
+	if n_frames == 0:
+		return out
+
+	frames = np.lib.stride_tricks.sliding_window_view(x, fft_size)[::hop][:n_frames]
+
+	# unshifted indices of the center bins, so no full fftshift is needed
+	center_idx = np.arange(-(keep_bins // 2), keep_bins - (keep_bins // 2)) % fft_size
+
+	batch = max(1, STFT_BATCH_SIZE // fft_size)
+
+	for start in range(0, n_frames, batch):
+		stop = min(start + batch, n_frames)
+		rows = out[start:stop]
+
+		fft = get_backend().fft(frames[start:stop], axis=1)
+		np.abs(fft[:, center_idx], out=rows, casting='unsafe')
+
+		np.square(rows, out=rows)
+		np.log10(rows, out=rows)
+		rows *= 10.0
+
+	return out
+
+
+def channelize(x, sample_rate, freq_offset, bandwidth):
+	"""
+	Digital downconverter, mixes freq_offset to 0 Hz then low-passes and decimates
+
+	The decimation is the largest integer that keeps bandwidth, done with a
+	polyphase FIR so only the output samples are computed
+
+	Returns (complex64 samples, output sample rate)
+	"""
+
+	if freq_offset:
+		# phase kept in float64 so long captures don't drift
+		phase = np.arange(len(x), dtype=np.float64)
+		phase *= -2 * np.pi * freq_offset / sample_rate
+		x = x * np.exp(1j * phase).astype(np.complex64)
+
+	decimation = max(1, int(sample_rate // bandwidth))
+	if decimation == 1:
+		return x, sample_rate
+
+	y = signal.resample_poly(x, 1, decimation)
+
+	return y.astype(np.complex64, copy=False), sample_rate / decimation
+
+
+# rows (and bins) of a psd_scan spectrogram, fewer when imaging given samples that can't fill it
+SCAN_ROWS = 512
+MIN_SCAN_ROWS = 64
+
+# length of psd_scan's live capture
+SCAN_SAMPLES = 2048000
+
+
+def _scan_fft_size(num_rows, bandwidth, sample_rate):
+	# num_rows bins across bandwidth
+	return max(num_rows, int(np.round(sample_rate / (bandwidth / num_rows))))
+
+
+def scan_samples(bandwidth, sample_rate, num_rows=SCAN_ROWS):
+	"""
+	Raw samples at sample_rate psd_scan needs to image bandwidth
+
+	Enough for num_rows frames of the channelized row FFT without overlap,
+	but no more than a live capture would give it
+	"""
+
+	decimation = max(1, int(sample_rate // bandwidth))
+
+	return min(num_rows * _scan_fft_size(num_rows, bandwidth, sample_rate / decimation) * decimation, SCAN_SAMPLES)
+
+
+def scan_rows(num_samples, bandwidth, sample_rate, max_rows=SCAN_ROWS):
+	"""
+	Rows of the largest spectrogram of bandwidth that num_samples at
+	sample_rate fill without empty rows, at most max_rows
+
+	Rows and bins shrink together, each row's FFT is about
+	num_rows * sample_rate / bandwidth points
+	"""
+
+	if num_samples <= 0:
+		return 0
+
+	rows = min(max_rows, math.isqrt(int(num_samples * bandwidth / sample_rate)) + 1)
+	while rows > 0 and rows * _scan_fft_size(rows, bandwidth, sample_rate) > num_samples:
+		rows -= 1
+
+	return rows
+
+
+async def psd_scan(sdr, center_freq, bandwidth, samps=None, sample_rate=None, dynamic_range=None, img_format="png", samps_freq=None,
+		deleted_samps=DEFAULT_SETTLE_SAMPS):
+	"""
+	Builds a spectrogram image of bandwidth around center_freq
+
+	If samps (raw uint8 IQ) is given it's used instead of a live capture,
+	sample_rate is the rate it was recorded at (rtl_sdr default if not set)
+	and samps_freq the frequency it was tuned to, if not center_freq. The
+	image gets fewer rows and bins if samps is too short to fill SCAN_ROWS
+
+	Narrow bandwidths are channelized down to about bandwidth first, so the
+	row FFTs stay under 1024 points however narrow the target is. Live
+	captures tune off to one side so the target isn't on the DC spike, and
+	throw away deleted_samps after the retune
+
+	Returns the image bytes, see render_spectrogram for dynamic_range and img_format
+	"""
 
 	samp_rate = 2.048e6
-	num_rows = 512
+	num_rows = SCAN_ROWS
 	x = None
 
-	if samps:
-		x = samps
+	# target's offset from the tuned frequency
+	freq_offset = 0
+
+	if samps is not None:
+		# raw uint8 IQ, e.g. from the TDOA capture
+		x = iq_to_complex(samps)
+
+		if not sample_rate:
+			sample_rate = samp_rate
+
+		if samps_freq and center_freq:
+			freq_offset = center_freq - samps_freq
 	else:
-		record_time = 1 #sec
+		total_samples = SCAN_SAMPLES
+
+		sample_rate = sdr.sample_rate
+
+		# room to move the target off DC and still keep it inside the passband
+		if bandwidth * 1.5 < sample_rate * 0.4:
+			freq_offset = -bandwidth
+
+		worker = device_worker(sdr)
+		raw = worker.buffer("scan", total_samples * 2)
+
+		def capture():
+			with metrics.stage("retune"):
+				sdr.center_freq = center_freq - freq_offset
 
-		total_samples = int(samp_rate * record_time)
+			with metrics.stage("settle_discard"):
+				read_raw(sdr, deleted_samps * 2)
 
-		sdr.center_freq = center_freq
+			# one continuous second, streamed so no samples drop between USB transfers
+			with metrics.stage("scan_read"):
+				return stream_bytes(sdr, total_samples * 2, out=raw)
 
-		sdr.read_samples(2048)
-		x = sdr.read_samples(total_samples)
+		x = iq_to_complex(await worker.call(capture))
 
-	x = x - np.mean(x)
+	x -= np.mean(x)
+
+	if bandwidth < sample_rate / 2 or freq_offset:
+		with metrics.stage("channelize"):
+			x, sample_rate = channelize(x, sample_rate, freq_offset, bandwidth)
+
+	total_samples = len(x)
+
+	if samps is not None:
+		num_rows = max(1, scan_rows(total_samples, bandwidth, sample_rate))
 
 	spectrogram_width = bandwidth
 
 	bin_width = spectrogram_width / num_rows
-	fft_size = int(np.round(sdr.sample_rate / bin_width))
-	hop = int(total_samples / num_rows)
+	fft_size = max(num_rows, int(np.round(sample_rate / bin_width)))
+	hop = max(1, int(total_samples / num_rows))
 
-	spectrogram = np.zeros((num_rows, num_rows))
+	with metrics.stage("stft"):
+		spectrogram = stft_rows(x, fft_size, hop, num_rows, num_rows)
 
-	for i in range(num_rows):
-		start = i * hop
-		if start + fft_size > total_samples:
-			break
-		window = x[start:start + fft_size]
-		fft = np.fft.fftshift(np.fft.fft(window))
-		center = fft_size // 2
-		spectrogram[i, :] = 10 * np.log10(np.abs(fft[center - 256:center + 256]) ** 2)
+	with metrics.stage("render"):
+		return render_spectrogram(spectrogram, dynamic_range=dynamic_range, img_format=img_format)
 
 
-	plt.figure(figsize=(512/100, 512/100), dpi=100)
-	plt.axis('off')
-	plt.gca().set_position([0, 0, 1, 1])
-	plt.imshow(spectrogram, aspect='auto')
+def _viridis_lut():
+	"""
+	256 entry uint8 RGB viridis table, from a polynomial fit so matplotlib isn't needed
+	"""
 
-	buf = io.BytesIO()
-	plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0)
-	plt.close()
-	buf.seek(0)
+	coeffs = np.array([
+		[0.2777273272234177, 0.005407344544966578, 0.3340998053353061],
+		[0.1050930431085774, 1.404613529898575, 1.384590162594685],
+		[-0.3308618287255563, 0.214847559468213, 0.09509516302823659],
+		[-4.634230498983486, -5.799100973351585, -19.33244095627987],
+		[6.228269936347081, 14.17993336680509, 56.69055260068105],
+		[4.776384997670288, -13.74514537774601, -65.35303263337234],
+		[-5.435455855934631, 4.645852612178535, 26.3124352495832],
+	])
 
-	binary_data = buf.getvalue()
+	t = np.linspace(0, 1, 256)[:, None]
+	rgb = sum(c * t ** k for k, c in enumerate(coeffs))
+
+	return np.round(np.clip(rgb, 0, 1) * 255).astype(np.uint8)
+
+
+COLORMAP_LUT = _viridis_lut()
+
+# Pillow format name and save options for each supported spectrogram image format
+IMG_FORMATS = {
+	"png": ("PNG", {"compress_level": 1}),
+	"webp": ("WEBP", {"lossless": True, "quality": 0, "method": 0}),
+}
+
+
+def render_spectrogram(spectrogram, dynamic_range=None, img_format="png"):
+	"""
+	Maps a dB spectrogram through COLORMAP_LUT and encodes it with Pillow
+
+	Args:
+	spectrogram: 2-D array of dB values, row 0 is the top of the image
+	dynamic_range: dB shown below the peak, None scales min to max like imshow
+	img_format: "png" or "webp" (lossless)
+
+	Returns the encoded image bytes
+	"""
+
+	if img_format not in IMG_FORMATS:
+		raise ValueError(f"unsupported image format: {img_format}")
+
+	db = np.array(spectrogram, dtype=np.float32)
+	finite = db[np.isfinite(db)]
+
+	top = float(finite.max()) if finite.size else 0.0
+	bottom = float(finite.min()) if finite.size else 0.0
+	if dynamic_range:
+		bottom = top - float(dynamic_range)
+
+	scale = 255.0 / (top - bottom) if top > bottom else 0.0
+
+	# scale to colormap indices in place, nan (empty rows) goes to the bottom
+	db -= bottom
+	db *= scale
+	np.nan_to_num(db, copy=False, nan=0.0)
+	np.clip(db, 0, 255, out=db)
+
+	rgb = COLORMAP_LUT[db.astype(np.uint8)]
+
+	pil_format, save_args = IMG_FORMATS[img_format]
+
+	buf = io.BytesIO()
+	Image.fromarray(rgb).save(buf, format=pil_format, **save_args)
 
-	return binary_data
+	return buf.getvalue()
 
 
 
@@ -0,0 +1,169 @@
+import os
+import collections
+import numpy as np
+from scipy import signal
+
+
+class FFTBackend:
+	"""
+	numpy FFT plus the per-size caches every backend shares
+
+	window() and window_norm() are computed once per FFT size instead of on
+	every hop
+	"""
+
+	name = "numpy"
+
+	def __init__(self, workers=None):
+		self.workers = workers or os.cpu_count() or 1
+
+		self._windows = {}
+
+	def window(self, N):
+		"""
+		Returns the cached float32 hann window for N points
+		"""
+
+		if N not in self._windows:
+			window = signal.windows.hann(N)
+			self._windows[N] = (window.astype(np.float32), float(np.sum(window ** 2)))
+
+		return self._windows[N][0]
+
+	def window_norm(self, N):
+		"""
+		Returns N * sum(window ** 2), the PSD scaling for the N point window
+		"""
+
+		self.window(N)
+
+		return N * self._windows[N][1]
+
+	def fft(self, x, axis=-1, overwrite_x=False):
+		return np.fft.fft(x, axis=axis)
+
+
+class ScipyFFTBackend(FFTBackend):
+	"""
+	scipy.fft, batched (2-D) transforms are split over workers threads
+	"""
+
+	name = "scipy"
+
+	def __init__(self, workers=None):
+		super().__init__(workers)
+
+		import scipy.fft
+		self._fft = scipy.fft.fft
+
+	def fft(self, x, axis=-1, overwrite_x=False):
+		workers = self.workers if np.ndim(x) > 1 else 1
+
+		return self._fft(x, axis=axis, overwrite_x=overwrite_x, workers=workers)
+
+
+class FFTWBackend(FFTBackend):
+	"""
+	pyFFTW, FFTW plans are built once per shape and dtype and reused
+
+	Plans use FFTW_ESTIMATE, FFTW_MEASURE would time trial transforms for
+	every new shape in the middle of a sweep. Only the max_plans most
+	recently used are kept, each holds aligned buffers the size of its input
+	"""
+
+	name = "fftw"
+
+	def __init__(self, workers=None, max_plans=16):
+		super().__init__(workers)
+
+		import pyfftw.builders
+
+		self._builders = pyfftw.builders
+		self.max_plans = max_plans
+		self._plans = collections.OrderedDict()
+
+	def fft(self, x, axis=-1, overwrite_x=False):
+		x = np.asarray(x)
+		key = (x.shape, x.dtype, axis)
+
+		plan = self._plans.get(key)
+		if plan is None:
+			threads = self.workers if x.ndim > 1 else 1
+			plan = self._builders.fft(
+				np.empty(x.shape, dtype=x.dtype),
+				axis=axis,
+				threads=threads,
+				planner_effort="FFTW_ESTIMATE",
+				avoid_copy=False
+			)
+
+			self._plans[key] = plan
+			if len(self._plans) > self.max_plans:
+				self._plans.popitem(last=False)
+		else:
+			self._plans.move_to_end(key)
+
+		# the plan copies x into its own aligned input, so the output must be copied out
+		return plan(x).copy()
+
+
+BACKENDS = {
+	"numpy": FFTBackend,
+	"scipy": ScipyFFTBackend,
+	"fftw": FFTWBackend,
+}
+
+# tried in order when no backend is named
+AUTO_ORDER = ("fftw", "scipy", "numpy")
+
+_backend = None
+
+
+def available_backends():
+	"""
+	Returns the names of the backends that import on this node
+	"""
+
+	names = []
+	for name in AUTO_ORDER:
+		try:
+			BACKENDS[name]()
+			names.append(name)
+		except ImportError:
+			pass
+
+	return names
+
+
+def set_backend(name=None, workers=None):
+	"""
+	Selects the FFT backend, None picks the fastest one installed
+
+	Returns the backend
+	"""
+
+	global _backend
+
+	if name:
+		_backend = BACKENDS[name](workers)
+		return _backend
+
+	for auto_name in AUTO_ORDER:
+		try:
+			_backend = BACKENDS[auto_name](workers)
+			break
+		except ImportError:
+			continue
+
+	return _backend
+
+
+def get_backend():
+	"""
+	Returns the current FFT backend, auto selected on first use
+	"""
+
+	if _backend is None:
+		set_backend(os.getenv('FFT_BACKEND') or None)
+
+	return _backend
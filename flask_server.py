@@ -3,11 +3,13 @@ import threading
 import subprocess
 import asyncio
 import requests
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
 from dotenv import load_dotenv
 import git
 import logging
 
+import metrics
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -84,6 +86,10 @@ class FlaskServer:
 		def update_and_restart():
 			return self._update_and_restart()
 
+		@self.app.route('/metrics')
+		def prometheus_metrics():
+			return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 
 	def _check_updates(self):
 		"""Internal method to check for updates, reusable by route and async checker."""
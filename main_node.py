@@ -1,5 +1,7 @@
 import os
+import time
 import asyncio
+import contextlib
 import sys
 import msgpack
 import socketio
@@ -11,6 +13,10 @@ from flask_server import FlaskServer
 from dotenv import load_dotenv
 
 import dsp_handler as DSP
+import metrics
+from psd_frame import PSDFrameEncoder
+from tdoa import TDOAReducer, TDOACorrelator
+from calibration import PassbandCalibration, SettleCalibration, SAMPLE_RATES, SETTLE_FREQS
 from socketio_client import SignalingClient
 from webrtc_client import WebRTCClient
 
@@ -26,34 +32,207 @@ class SDR_Handler:
 		self.wideband_center_freq = 850e6
 		self.wideband_bandwidth = 5e6
 
+		self.sample_rate = 2.4e6
+		self.calibration = PassbandCalibration.load(self.dev_id, self.sample_rate)
+
+		# per frequency retune settle, None discards DSP.DEFAULT_SETTLE_SAMPS on every hop
+		self.settle = SettleCalibration.load(self.dev_id)
+
+		# Welch averaging per hop, 1 is a single FFT frame
+		self.averages = 1
+		self.overlap = 0.5
+		self.sweep_plan = None
+		self.update_sweep_plan()
+
 		self.target_freq = None
 		self.trigger_db = None
 		self.trigger_bw = None
 
 		self.trigger_active = False
 
+		# list of {"freq", "bw", "db"} bands watched while trigger_active
+		self.triggers = []
+		self.trigger_engine = None
+
+		# samples read after a trigger to extend the pre-trigger captures
+		self.post_trigger_samples = 0
+
+		# how sweeps over the display width are reduced, see DSP.decimate_psd
+		self.decimation = "max"
+
+		# quantized PSD frames, None sends the float32 sweep as is
+		self.psd_encoder = None
+
+		# per-bin noise floor change detection, None when off
+		self.baseline = None
+
+		# spectrogram image settings, None dynamic range autoscales
+		self.img_dynamic_range = None
+		self.img_format = "png"
+
 		self.reference_freq = None
 		self.tdoa_samp_num = 2e6
 
+		# upload TDOA packets while the capture runs instead of after it
+		self.tdoa_stream = True
+
+		# None uploads the raw capture, otherwise each segment is filtered and decimated first
+		self.tdoa_reducer = None
+
+		# set to correlate on the node and upload lags instead of IQ
+		self.tdoa_correlator = None
+
 		self.sdr = None
 		self.scan = True
 
 		self.sdr_lock = asyncio.Lock()
 
-	async def capture_spectrogram(self, samps=None):
+	def update_sweep_plan(self):
+		"""
+		Rebuilds the sweep plan, call whenever the scan settings change
+		"""
+
+		start_freq = int(self.wideband_center_freq) - (int(self.wideband_bandwidth) / 2)
+		stop_freq = int(self.wideband_center_freq) + (int(self.wideband_bandwidth) / 2)
+
+		self.sweep_plan = DSP.SweepPlan.build(
+			start_freq,
+			stop_freq,
+			self.sample_rate,
+			averages=self.averages,
+			overlap=self.overlap,
+			calibration=self.calibration,
+			settle=self.settle
+		)
+
+	def set_sample_rate(self, sample_rate):
+		"""
+		Switches the sweep sample rate, loads that rate's calibration if there is one
+		"""
+
+		if sample_rate not in SAMPLE_RATES:
+			print(f"[!] Unsupported sample rate: {sample_rate}")
+			return
 
-		if self.rtc_handler and samps:
-			samp_out = await DSP.psd_scan(samps)
+		self.sample_rate = sample_rate
+		self.calibration = PassbandCalibration.load(self.dev_id, sample_rate)
+		self.update_sweep_plan()
+
+	async def calibrate(self, freqs=None):
+		"""
+		Measures the passband and DC offset at the current sample rate and saves it
+
+		Run with the antenna disconnected or on a quiet band
+		"""
+
+		if not freqs:
+			freqs = [self.wideband_center_freq + offset for offset in (-2e6, 0, 2e6)]
+
+		async with metrics.timed_lock(self.sdr_lock):
+			if not self.sdr:
+				self.sdr = DSP.rtl_config(samp_rate=self.sample_rate, device_id=int(self.dev_id))
+			elif self.sdr.sample_rate != self.sample_rate:
+				# set_sample_rate only takes effect on the dongle at the next sweep
+				self.sdr.sample_rate = self.sample_rate
+
+			self.calibration = await DSP.device_worker(self.sdr).call(PassbandCalibration.measure, self.sdr, freqs)
+
+		self.calibration.save(self.dev_id)
+		self.update_sweep_plan()
+
+		print(f"[*] Calibrated {self.sample_rate / 1e6} Msps, usable bandwidth {self.calibration.hop_width / 1e6} MHz")
+
+	async def calibrate_settle(self, freqs=None):
+		"""
+		Measures how long the tuner takes to settle after a retune across its range and saves it
+		"""
+
+		async with metrics.timed_lock(self.sdr_lock):
+			if not self.sdr:
+				self.sdr = DSP.rtl_config(samp_rate=self.sample_rate, device_id=int(self.dev_id))
+			elif self.sdr.sample_rate != self.sample_rate:
+				self.sdr.sample_rate = self.sample_rate
+
+			self.settle = await DSP.device_worker(self.sdr).call(lambda: SettleCalibration.measure(
+				self.sdr,
+				freqs or SETTLE_FREQS,
+				step_hz=self.sweep_plan.hop_width
+			))
+
+		self.settle.save(self.dev_id)
+		self.update_sweep_plan()
+
+		print(f"[*] Settle calibrated, {sum(self.sweep_plan.discards)} samples discarded per sweep")
+
+	def set_trigger_settings(self, data):
+		"""
+		Sets the trigger bands from setTriggerSettings data
+
+		Takes either a single targetFrequency/bandwidth/dbLevel (MHz, MHz, dB)
+		or a "triggers" list of them. "mode": "cfar" uses the CFAR detector
+		(optional "pfa", "guardCells", "trainCells") instead of dbLevel.
+		"pretrigger" keeps up to that many recent captures of each watched hop
+		to image a trigger from, "postTriggerSamples" extends them after it fires
+		"""
+
+		trigger_list = data.get('triggers') or [data]
+
+		triggers = []
+		for trigger in trigger_list:
+			if trigger.get('targetFrequency') and trigger.get('bandwidth'):
+				triggers.append({
+					"freq": float(trigger['targetFrequency']) * 1e6,
+					"bw": float(trigger['bandwidth']) * 1e6,
+					"db": float(trigger['dbLevel']) if trigger.get('dbLevel') is not None else float("inf")
+				})
+
+		detector = None
+		if data.get('mode') == 'cfar':
+			detector = DSP.CFARDetector(
+				train=data.get('trainCells', 16),
+				guard=data.get('guardCells', 2),
+				pfa=data.get('pfa', 1e-6)
+			)
+
+		# first trigger is still used as the TDOA target
+		self.trigger_db = trigger_list[0].get('dbLevel')
+		self.trigger_bw = trigger_list[0].get('bandwidth')
+		self.target_freq = trigger_list[0].get('targetFrequency')
+
+		self.triggers = triggers
+		self.post_trigger_samples = int(data.get('postTriggerSamples') or 0)
+
+		self.trigger_engine = None
+		if triggers or detector:
+			self.trigger_engine = DSP.TriggerEngine(
+				triggers,
+				detector=detector,
+				pretrigger_depth=int(data.get('pretrigger') or 0)
+			)
+
+	async def capture_spectrogram(self, samps=None, bandwidth=2.048e6, sample_rate=2.048e6):
+
+		if self.rtc_handler and samps is not None:
+			psd_type = "IMG"
+			samp_out = await DSP.psd_scan(
+					sdr=None,
+					center_freq=None,
+					bandwidth=bandwidth,
+					samps=samps,
+					sample_rate=sample_rate,
+					dynamic_range=self.img_dynamic_range,
+					img_format=self.img_format
+				)
 			bin_size = 16384
 			data_len = len(samp_out)
 
 			for i in range(0, data_len, bin_size):
 				chunk = samp_out[i:i + bin_size]
-				packeted = msgpack.packb({"type": psd_type, "data": chunk}, use_bin_type=True)
+				packeted = msgpack.packb({"type": psd_type, "format": self.img_format, "data": chunk}, use_bin_type=True)
 				await self.rtc_handler.send_data(packeted)
 				await asyncio.sleep(0.01)
 
-			packeted = msgpack.packb({"type": psd_type, "data": "complete"}, use_bin_type=True)
+			packeted = msgpack.packb({"type": psd_type, "format": self.img_format, "data": "complete"}, use_bin_type=True)
 			await self.rtc_handler.send_data(packeted)
 
 	async def start_wideband(self):
@@ -61,22 +240,25 @@ class SDR_Handler:
 
 		while self.scan:
 
-			start_freq = int(self.wideband_center_freq) - (int(self.wideband_bandwidth) / 2)
-			stop_freq = int(self.wideband_center_freq) + (int(self.wideband_bandwidth) / 2)
+			plan = self.sweep_plan
+			start_freq = plan.start_freq
+			stop_freq = plan.stop_freq
 
 			# acquire lock before running scan
-			async with self.sdr_lock:
+			async with metrics.timed_lock(self.sdr_lock):
 				if not self.sdr:
-					self.sdr = DSP.rtl_config(samp_rate=2.4e6, device_id=int(self.dev_id))
+					self.sdr = DSP.rtl_config(samp_rate=self.sample_rate, device_id=int(self.dev_id))
+				elif self.sdr.sample_rate != plan.sample_rate:
+					self.sdr.sample_rate = plan.sample_rate
 
 				samp_out, psd_type = await DSP.psd_loop(
 						sdr=self.sdr,
-						start_freq=int(start_freq),
-						stop_freq=int(stop_freq),
-						target_freq=self.target_freq,
-						trigger_db=self.trigger_db,
-						trigger_bw=self.trigger_bw,
-						trigger_active=self.trigger_active
+						plan=plan,
+						trigger_engine=self.trigger_engine if self.trigger_active else None,
+						dynamic_range=self.img_dynamic_range,
+						img_format=self.img_format,
+						reducer=self.decimation,
+						post_trigger_samples=self.post_trigger_samples
 					)
 
 				if psd_type == "IMG" and self.rtc_handler:
@@ -86,22 +268,91 @@ class SDR_Handler:
 
 					for i in range(0, data_len, bin_size):
 						chunk = samp_out[i:i + bin_size]
-						packeted = msgpack.packb({"type": psd_type, "data": chunk}, use_bin_type=True)
+						packeted = msgpack.packb({"type": psd_type, "format": self.img_format, "data": chunk}, use_bin_type=True)
 						await self.rtc_handler.send_data(packeted)
 						await asyncio.sleep(0.01)
 
-					packeted = msgpack.packb({"type": psd_type, "data": "complete"}, use_bin_type=True)
+					packeted = msgpack.packb({"type": psd_type, "format": self.img_format, "data": "complete"}, use_bin_type=True)
 					await self.rtc_handler.send_data(packeted)
 
 				elif psd_type == 'PSD' and self.rtc_handler:
-					packeted = msgpack.packb({"type": psd_type, "data": samp_out}, use_bin_type=True)
-					await self.rtc_handler.send_data(packeted)
+					# decimate_psd only changes the length when it reduced the sweep
+					decimated = len(samp_out) != plan.total_bins
+					minmax = decimated and self.decimation == "minmax"
+
+					with metrics.stage("pack"):
+						if self.psd_encoder:
+							frame = self.psd_encoder.encode(samp_out, start_freq, stop_freq, minmax=minmax)
+							packeted = msgpack.packb({"type": "PSDF", "data": frame}, use_bin_type=True)
+						else:
+							# float32 sweep buffer is sent as raw little endian bytes, no list conversion
+							packeted = msgpack.packb({
+								"type": psd_type,
+								"dtype": "float32",
+								"decimation": self.decimation if decimated else None,
+								"data": memoryview(samp_out)
+							}, use_bin_type=True)
+					sent = await self.rtc_handler.send_data(packeted)
+
+					# delta frames only build on frames the client got
+					if sent and self.psd_encoder:
+						self.psd_encoder.sent()
+
+					if self.baseline:
+						# the full resolution sweep, samp_out may be minmax pairs or group maxima
+						changes = self.baseline.update(DSP.sweep_buffer(plan.total_bins), start_freq, stop_freq)
+						if changes:
+							packeted = msgpack.packb({"type": "CHG", "data": changes}, use_bin_type=True)
+							await self.rtc_handler.send_data(packeted)
+
+					# CFAR detections from this sweep
+					if self.trigger_active and self.trigger_engine and self.trigger_engine.peaks:
+						packeted = msgpack.packb({"type": "DET", "data": self.trigger_engine.peaks}, use_bin_type=True)
+						await self.rtc_handler.send_data(packeted)
 
 
 
 		print("[*] Exiting scan")
 
 
+	async def send_tdoa_packet(self, data, meta=None):
+		packet = {
+				"data": data
+				}
+
+		if meta:
+			packet["meta"] = meta
+
+		await self.send_tdoa_message(packet)
+
+	async def send_tdoa_message(self, message):
+		with metrics.stage("tdoa_send"):
+			packeted = msgpack.packb(message, use_bin_type=True)
+			await self.ws_handler.send_message('tdoaOut', packeted)
+
+		metrics.BYTES_SENT.inc(len(packeted), "ws")
+
+	async def send_tdoa_data(self, data, segment, freqs, packet_size):
+		"""
+		Sends raw capture bytes as one packet, or with a reducer set reduces
+		the segment and sends it in packet_size chunks
+
+		The first packet of a reduced segment carries its metadata under
+		"meta", the data up to the next one is that segment's integer IQ
+		"""
+
+		if not self.tdoa_reducer:
+			await self.send_tdoa_packet(data)
+			return
+
+		# reducing a 2M sample segment takes a while, keep the event loop free
+		loop = asyncio.get_running_loop()
+		with metrics.stage("tdoa_reduce"):
+			meta, reduced = await loop.run_in_executor(None, self.tdoa_reducer.reduce_segment, data, segment, freqs[segment % 2])
+
+		for index in range(0, len(reduced), packet_size):
+			await self.send_tdoa_packet(reduced[index:index + packet_size], meta=meta if index == 0 else None)
+
 	async def capture_tdoa(self):
 
 		try:
@@ -118,34 +369,63 @@ class SDR_Handler:
 		N = int(self.tdoa_samp_num)
 		maxN = int(1e5)
 
-		async with self.sdr_lock:
+		async with metrics.timed_lock(self.sdr_lock):
 			if self.sdr:
-				self.sdr.close()
+				DSP.close_device(self.sdr)
 				self.sdr = None
 
-			tdoa_task = asyncio.create_task(DSP.read_ext_samples(dev_id=self.dev_id, samp_num=N, freq1=freq1, freq2=freq2))
-			samp_out = await tdoa_task
-
-			samp_out = samp_out[:N*4]
-			print(f"samp len {len(samp_out)}")
+			capture_start = time.perf_counter()
 
 			try:
-				index = 0
-				while index < len(samp_out):
-					packet = {
-							"data": samp_out[index:index + maxN]
-							}
-
-					packeted = msgpack.packb(packet, use_bin_type=True)
-					await self.ws_handler.send_message('tdoaOut', packeted)
-					index += maxN
+				# raw captures go out in maxN byte packets, reduced ones a segment (N samples) at a time
+				packet_size = N * 2 if self.tdoa_reducer else maxN
+				freqs = (freq1, freq2)
+				segment = 0
+
+				if self.tdoa_correlator:
+					# correlation needs both segments, so the whole capture is read first
+					samp_out = await DSP.read_ext_samples(dev_id=self.dev_id, samp_num=N, freq1=freq1, freq2=freq2, expected_bytes=N*4)
+
+					loop = asyncio.get_running_loop()
+					with metrics.stage("tdoa_correlate"):
+						results = await loop.run_in_executor(None, self.tdoa_correlator.process, samp_out, N, freq1, freq2)
+
+					await self.send_tdoa_message({"xcorr": results})
+				elif self.tdoa_stream:
+					# packets go out while the capture is still running. aclosing kills
+					# rtl_sdr straight away if a send fails, not whenever the generator is collected
+					packets = DSP.stream_ext_samples(
+							dev_id=self.dev_id,
+							samp_num=N,
+							freq1=freq1,
+							freq2=freq2,
+							packet_size=packet_size,
+							expected_bytes=N*4)
+
+					async with contextlib.aclosing(packets):
+						async for packet in packets:
+							await self.send_tdoa_data(packet, segment, freqs, maxN)
+							segment += 1
+				else:
+					tdoa_task = asyncio.create_task(DSP.read_ext_samples(dev_id=self.dev_id, samp_num=N, freq1=freq1, freq2=freq2, expected_bytes=N*4))
+
+					# memoryview of the capture buffer, packets are slices of it so nothing is copied before msgpack
+					samp_out = await tdoa_task
+					print(f"samp len {len(samp_out)}")
+
+					index = 0
+					while index < len(samp_out):
+						await self.send_tdoa_data(samp_out[index:index + packet_size], segment, freqs, maxN)
+						index += packet_size
+						segment += 1
 
 				end_pack = {
 						"data": "none"
 						}
 
-				packeted_end = msgpack.packb(end_pack, use_bin_type=True)
-				await self.ws_handler.send_message('tdoaOut', packeted_end)
+				await self.send_tdoa_message(end_pack)
+
+				metrics.STAGE_SECONDS.observe(time.perf_counter() - capture_start, "tdoa_capture")
 
 				# will enable to send spectrograms to AEDA
 				# await self.capture_spectrogram(samps=samp_out[:N*2])
@@ -199,6 +479,7 @@ class MainNode:
 		self.socketio_handler.start_scan_callback = self.start_scan_callback
 		self.socketio_handler.tdoa_settings_callback = self.tdoa_settings_callback
 		self.socketio_handler.scan_settings_callback = self.scan_settings_callback
+		self.socketio_handler.calibrate_callback = self.calibrate_callback
 
 		await self.socketio_handler.connect()
 
@@ -238,6 +519,19 @@ class MainNode:
 		task = asyncio.create_task(self.sdr_handler.start_wideband())
 
 
+	async def calibrate_callback(self, data):
+		print("[*] calibrate callback")
+		freqs = None
+		if data and data.get('frequencies'):
+			freqs = [float(freq) * 1e6 for freq in data['frequencies']]
+
+		# 'settle' measures retune settling, anything else the passband
+		if data and data.get('mode') == 'settle':
+			await self.sdr_handler.calibrate_settle(freqs)
+		else:
+			await self.sdr_handler.calibrate(freqs)
+
+
 	async def tdoa_settings_callback(self, data):
 		print("[*] tdoa settings callback")
 		print(data)
@@ -251,6 +545,33 @@ class MainNode:
 		if data['referenceFrequency']:
 			self.sdr_handler.reference_freq = data['referenceFrequency']
 
+		if 'stream' in data:
+			self.sdr_handler.tdoa_stream = bool(data['stream'])
+
+		# on-node filtering and decimation, bandwidths in MHz
+		if 'reduce' in data:
+			if data['reduce']:
+				reducer = self.sdr_handler.tdoa_reducer or TDOAReducer()
+
+				try:
+					self.sdr_handler.tdoa_reducer = TDOAReducer(
+						ref_bandwidth=float(data.get('refBandwidth') or reducer.ref_bandwidth / 1e6) * 1e6,
+						target_bandwidth=float(data.get('targetBandwidth') or reducer.target_bandwidth / 1e6) * 1e6,
+						bits=int(data.get('bits') or reducer.bits)
+					)
+				except ValueError as e:
+					print(f"[!] Bad TDOA reduce settings: {e}")
+			else:
+				self.sdr_handler.tdoa_reducer = None
+
+		# on-node cross-correlation, overrides reduce
+		if 'correlate' in data:
+			if data['correlate']:
+				bandwidth = data.get('correlateBandwidth')
+				self.sdr_handler.tdoa_correlator = TDOACorrelator(bandwidth=float(bandwidth) * 1e6) if bandwidth else TDOACorrelator()
+			else:
+				self.sdr_handler.tdoa_correlator = None
+
 	async def scan_settings_callback(self, data):
 		if data['centerFreq']:
 			self.sdr_handler.wideband_center_freq = float(data['centerFreq']) * 1e6
@@ -258,6 +579,47 @@ class MainNode:
 		if data['bandwidth']:
 			self.sdr_handler.wideband_bandwidth = float(data['bandwidth']) * 1e6
 
+		if data.get('sampleRate'):
+			self.sdr_handler.set_sample_rate(float(data['sampleRate']) * 1e6)
+
+		if data.get('averages'):
+			self.sdr_handler.averages = max(1, int(data['averages']))
+
+		if data.get('overlap') is not None:
+			self.sdr_handler.overlap = float(data['overlap'])
+
+		self.sdr_handler.update_sweep_plan()
+
+		if self.sdr_handler.sweep_plan.averages < self.sdr_handler.averages:
+			print(f"[!] Averages limited to {self.sdr_handler.sweep_plan.averages} by the capture size")
+
+		if 'dynamicRange' in data:
+			self.sdr_handler.img_dynamic_range = float(data['dynamicRange']) if data['dynamicRange'] else None
+
+		if data.get('imageFormat') in DSP.IMG_FORMATS:
+			self.sdr_handler.img_format = data['imageFormat']
+
+		if data.get('decimation') in DSP.DECIMATION_REDUCERS:
+			self.sdr_handler.decimation = data['decimation']
+
+		if 'psdFormat' in data:
+			if data['psdFormat'] in ('u8', 'i16'):
+				self.sdr_handler.psd_encoder = PSDFrameEncoder(
+					bits=8 if data['psdFormat'] == 'u8' else 16,
+					delta=bool(data.get('psdDelta', False))
+				)
+			else:
+				self.sdr_handler.psd_encoder = None
+
+		if 'changeDetect' in data:
+			if data['changeDetect']:
+				self.sdr_handler.baseline = DSP.NoiseBaseline(
+					mode=data.get('baselineMode', 'ema'),
+					rise_db=data.get('changeDb', 10.0)
+				)
+			else:
+				self.sdr_handler.baseline = None
+
 
 
 
@@ -0,0 +1,194 @@
+import time
+import bisect
+import threading
+import contextlib
+
+
+# seconds, from a single small FFT up to a slow TDOA capture
+DEFAULT_BUCKETS = (5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = []
+_lock = threading.Lock()
+
+
+def _labels(label, value):
+	return f'{{{label}="{value}"}}' if label else ""
+
+
+class _Buckets:
+	__slots__ = ("counts", "sum", "count")
+
+	def __init__(self, size):
+		self.counts = [0] * size
+		self.sum = 0.0
+		self.count = 0
+
+
+class Histogram:
+	"""
+	Fixed bucket histogram, optionally split by one label
+
+	observe() is a bisect and three additions under the histogram's lock
+	(the device workers and the event loop observe concurrently), nothing is
+	allocated after a label value's first use
+	"""
+
+	kind = "histogram"
+
+	def __init__(self, name, help, buckets=DEFAULT_BUCKETS, label=None):
+		self.name = name
+		self.help = help
+		self.buckets = tuple(buckets)
+		self.label = label
+
+		self._children = {}
+		self._lock = threading.Lock()
+
+		with _lock:
+			_metrics.append(self)
+
+	def _child(self, value):
+		child = self._children.get(value)
+		if child is None:
+			# +Inf bucket at the end
+			child = self._children.setdefault(value, _Buckets(len(self.buckets) + 1))
+		return child
+
+	def observe(self, seconds, value=None):
+		index = bisect.bisect_left(self.buckets, seconds)
+
+		with self._lock:
+			child = self._child(value)
+			child.counts[index] += 1
+			child.sum += seconds
+			child.count += 1
+
+	def time(self, value=None):
+		"""
+		Context manager observing the time spent in its block
+		"""
+
+		return _Timer(self, value)
+
+	def render(self):
+		# copied under the lock so each child's buckets, sum and count agree
+		with self._lock:
+			children = [(value, list(child.counts), child.sum, child.count) for value, child in self._children.items()]
+
+		lines = []
+		for value, counts, total_sum, total_count in children:
+			base = f'{self.label}="{value}",' if self.label else ""
+
+			total = 0
+			for bound, count in zip(self.buckets + (float("inf"),), counts):
+				total += count
+				le = "+Inf" if bound == float("inf") else repr(bound)
+				lines.append(f'{self.name}_bucket{{{base}le="{le}"}} {total}')
+
+			labels = _labels(self.label, value)
+			lines.append(f"{self.name}_sum{labels} {total_sum}")
+			lines.append(f"{self.name}_count{labels} {total_count}")
+
+		return lines
+
+
+class Counter:
+	"""
+	Monotonic total, optionally split by one label
+	"""
+
+	kind = "counter"
+
+	def __init__(self, name, help, label=None):
+		self.name = name
+		self.help = help
+		self.label = label
+
+		self._values = {}
+		self._lock = threading.Lock()
+
+		with _lock:
+			_metrics.append(self)
+
+	def inc(self, amount=1, value=None):
+		with self._lock:
+			self._values[value] = self._values.get(value, 0) + amount
+
+	def render(self):
+		with self._lock:
+			values = list(self._values.items())
+
+		return [f"{self.name}{_labels(self.label, value)} {total}" for value, total in values]
+
+
+class Gauge(Counter):
+	"""
+	Last value set, optionally split by one label
+	"""
+
+	kind = "gauge"
+
+	def set(self, amount, value=None):
+		with self._lock:
+			self._values[value] = amount
+
+
+class _Timer:
+	__slots__ = ("histogram", "value", "start")
+
+	def __init__(self, histogram, value):
+		self.histogram = histogram
+		self.value = value
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		self.histogram.observe(time.perf_counter() - self.start, self.value)
+
+
+STAGE_SECONDS = Histogram("aeda_stage_seconds", "Time spent in each DSP and I/O stage", label="stage")
+LOCK_WAIT_SECONDS = Histogram("aeda_sdr_lock_wait_seconds", "Time spent waiting for the SDR lock")
+
+SWEEPS = Counter("aeda_sweeps_total", "Completed wideband sweeps")
+SWEEP_RATE = Gauge("aeda_sweep_rate", "Sweeps per second, from the last sweep")
+BYTES_SENT = Counter("aeda_bytes_sent_total", "Bytes sent upstream", label="channel")
+DROPPED_FRAMES = Counter("aeda_dropped_frames_total", "Messages dropped because the data channel was closed or failed")
+
+
+def stage(name):
+	"""
+	Times a block into the aeda_stage_seconds histogram under name
+	"""
+
+	return STAGE_SECONDS.time(name)
+
+
+@contextlib.asynccontextmanager
+async def timed_lock(lock):
+	"""
+	async with for an asyncio.Lock that records how long acquiring it took
+	"""
+
+	start = time.perf_counter()
+	async with lock:
+		LOCK_WAIT_SECONDS.observe(time.perf_counter() - start)
+		yield
+
+
+def render():
+	"""
+	Returns every metric in Prometheus text exposition format
+	"""
+
+	with _lock:
+		metrics = list(_metrics)
+
+	lines = []
+	for metric in metrics:
+		lines.append(f"# HELP {metric.name} {metric.help}")
+		lines.append(f"# TYPE {metric.name} {metric.kind}")
+		lines.extend(metric.render())
+
+	return "\n".join(lines) + "\n"
@@ -0,0 +1,188 @@
+import time
+import zlib
+import struct
+import numpy as np
+
+
+# version, flags, bin count, sequence, timestamp, start Hz, stop Hz, dB scale, dB offset
+HEADER = struct.Struct("<BBIIdddff")
+VERSION = 1
+
+FLAG_INT16 = 0x01
+FLAG_DELTA = 0x02
+FLAG_MINMAX = 0x04
+FLAG_ZLIB = 0x08
+
+# fastest zlib level, small deltas compress about as well at 1 as at 9
+ZLIB_LEVEL = 1
+
+# default (dB per step, dB at code 0) for each sample width
+DEFAULT_SCALING = {
+	8: (0.5, -110.0),
+	16: (0.01, -160.0),
+}
+
+
+class PSDFrameEncoder:
+	"""
+	Packs PSD sweeps into compact binary frames
+
+	A frame is a HEADER followed by the bins quantized to uint8 or int16:
+	db = offset + code * scale. With delta set, frames between keyframes
+	carry the wrapping difference from the previous frame's codes instead,
+	zlib compressed since that's where the saving is (the raw difference is
+	the same size as the codes). Deltas are taken against the last frame
+	marked sent(), so a frame the channel dropped doesn't break the chain
+
+	Quantizing works in preallocated buffers straight from the numpy
+	array, no Python lists are built. minmax marks a sweep of interleaved
+	(min, max) pairs from decimate_psd
+	"""
+
+	def __init__(self, bits=8, scale=None, offset=None, delta=False, keyframe_interval=30):
+		if bits not in DEFAULT_SCALING:
+			raise ValueError(f"unsupported frame bits: {bits}")
+
+		default_scale, default_offset = DEFAULT_SCALING[bits]
+
+		self.bits = bits
+		self.scale = float(scale) if scale else default_scale
+		self.offset = float(offset) if offset is not None else default_offset
+		self.delta = delta
+		self.keyframe_interval = keyframe_interval
+
+		self.dtype = np.dtype("<i2") if bits == 16 else np.dtype(np.uint8)
+		self.code_min = np.iinfo(self.dtype).min
+		self.code_max = np.iinfo(self.dtype).max
+
+		self.seq = 0
+
+		self._key = None
+		self._since_key = 0
+		self._pending = None
+		self._work = None
+		self._codes = None
+		self._prev = None
+
+	def _buffers(self, size):
+		if self._work is None or len(self._work) != size:
+			self._work = np.empty(size, dtype=np.float32)
+			self._codes = np.empty(size, dtype=self.dtype)
+			self._prev = np.zeros(size, dtype=self.dtype)
+
+	def encode(self, psd, start_freq, stop_freq, timestamp=None, minmax=False):
+		"""
+		Returns the frame bytes for a sweep of dB values
+		"""
+
+		n = len(psd)
+		self._buffers(n)
+
+		work = self._work
+		codes = self._codes
+
+		np.subtract(psd, self.offset, out=work)
+		np.multiply(work, 1.0 / self.scale, out=work)
+		np.rint(work, out=work)
+		np.nan_to_num(work, copy=False, nan=self.code_min)
+		np.clip(work, self.code_min, self.code_max, out=work)
+		codes[:] = work
+
+		flags = FLAG_INT16 if self.bits == 16 else 0
+		if minmax:
+			flags |= FLAG_MINMAX
+
+		# keyframe on layout change or every keyframe_interval frames
+		key = (n, start_freq, stop_freq)
+		keyframe = key != self._key or self._since_key >= self.keyframe_interval
+
+		payload = codes.tobytes()
+		if self.delta and not keyframe:
+			flags |= FLAG_DELTA | FLAG_ZLIB
+			# integer subtraction wraps, decode undoes it with a wrapping add
+			diff = np.subtract(codes, self._prev, out=work.view(self.dtype)[:n])
+			payload = zlib.compress(diff.tobytes(), ZLIB_LEVEL)
+
+		self._pending = (key, keyframe)
+
+		header = HEADER.pack(
+			VERSION,
+			flags,
+			n,
+			self.seq & 0xFFFFFFFF,
+			time.time() if timestamp is None else timestamp,
+			float(start_freq),
+			float(stop_freq),
+			self.scale,
+			self.offset
+		)
+
+		self.seq += 1
+
+		return header + payload
+
+	def sent(self):
+		"""
+		Marks the last encoded frame as delivered, the next delta is taken against it
+		"""
+
+		if self._pending is None:
+			return
+
+		key, keyframe = self._pending
+		self._pending = None
+
+		if keyframe:
+			self._key = key
+			self._since_key = 1
+		else:
+			self._since_key += 1
+
+		if self.delta:
+			self._prev[:] = self._codes
+
+
+def decode_frame(frame, prev_codes=None):
+	"""
+	Unpacks a frame from PSDFrameEncoder
+
+	prev_codes is the codes array returned for the previous frame, needed
+	for delta frames
+
+	Returns (header dict, codes, float32 dB values)
+	"""
+
+	version, flags, n, seq, timestamp, start_freq, stop_freq, scale, offset = HEADER.unpack_from(frame)
+
+	if version != VERSION:
+		raise ValueError(f"unsupported frame version: {version}")
+
+	dtype = np.dtype("<i2") if flags & FLAG_INT16 else np.dtype(np.uint8)
+
+	if flags & FLAG_ZLIB:
+		codes = np.frombuffer(zlib.decompress(memoryview(frame)[HEADER.size:]), dtype=dtype, count=n)
+	else:
+		codes = np.frombuffer(frame, dtype=dtype, count=n, offset=HEADER.size)
+
+	if flags & FLAG_DELTA:
+		if prev_codes is None:
+			raise ValueError("delta frame without a previous frame")
+		codes = codes + prev_codes
+
+	psd = codes.astype(np.float32)
+	psd *= scale
+	psd += offset
+
+	header = {
+		"seq": seq,
+		"timestamp": timestamp,
+		"start_freq": start_freq,
+		"stop_freq": stop_freq,
+		"bins": n,
+		"scale": scale,
+		"offset": offset,
+		"delta": bool(flags & FLAG_DELTA),
+		"minmax": bool(flags & FLAG_MINMAX),
+	}
+
+	return header, codes, psd
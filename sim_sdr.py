@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Simulated SDRs that stand in for RtlSdr when no dongle is attached
+
+FileSdr replays recorded uint8 IQ (rtl_sdr's output format) from a memory
+map, SyntheticSdr generates tones in noise. Both honor center_freq,
+sample_rate, read_bytes and read_samples, and mimic a retune: the first
+settle_time seconds after center_freq changes carry a decaying DC step and
+gain ramp, like the tuner's PLL and AGC settling
+
+Pick one with the SDR_DEVICE environment variable, see open_device. Run as
+a script it replaces librtlsdr-2freq's rtl_sdr for the TDOA capture
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+
+class SimSdr:
+	"""
+	Base for the simulated devices, subclasses implement _generate(n)
+	returning complex64 baseband at the current tuning
+	"""
+
+	valid_gains_db = [0.0, 0.9, 1.4, 2.7, 3.7, 7.7, 8.7, 12.5, 14.4, 15.7, 16.6, 19.7, 20.7, 22.9, 25.4,
+		28.0, 29.7, 32.8, 33.8, 36.4, 37.2, 38.6, 40.2, 42.1, 43.4, 43.9, 44.5, 48.0, 49.6]
+
+	def __init__(self, sample_rate=2.048e6, center_freq=100e6, settle_time=1e-3, realtime=False, seed=0):
+		self.sample_rate = float(sample_rate)
+		self._center_freq = float(center_freq)
+		self.settle_time = settle_time
+		self.realtime = realtime
+		self.gain = 30
+		self.freq_correction = 0
+
+		self.rng = np.random.default_rng(seed)
+
+		# samples since the last retune
+		self._since_tune = 0
+		self._dc_step = 0j
+
+	@property
+	def center_freq(self):
+		return self._center_freq
+
+	@center_freq.setter
+	def center_freq(self, freq):
+		self._center_freq = float(freq)
+
+		self._since_tune = 0
+		self._dc_step = complex(*self.rng.uniform(-0.3, 0.3, 2))
+
+		if self.realtime:
+			# rtl-sdr's retune is a few USB control transfers
+			time.sleep(0.5e-3)
+
+	def set_agc_mode(self, enabled):
+		pass
+
+	def close(self):
+		pass
+
+	def _settle(self, x):
+		# exponential settle, time constant a fifth of settle_time
+		settle_samps = int(self.settle_time * self.sample_rate)
+		if self._since_tune >= settle_samps:
+			return x
+
+		n = min(len(x), settle_samps - self._since_tune)
+		t = (np.arange(self._since_tune, self._since_tune + n, dtype=np.float32)) / (settle_samps / 5)
+		decay = np.exp(-t)
+
+		x = x.copy()
+		x[:n] *= 1 - decay
+		x[:n] += self._dc_step * decay
+
+		return x
+
+	def read_bytes(self, num_bytes):
+		"""
+		Returns num_bytes of interleaved uint8 IQ, like RtlSdr.read_bytes
+		"""
+
+		n = num_bytes // 2
+		start = time.perf_counter()
+
+		x = self._settle(self._generate(n))
+		self._since_tune += n
+
+		iq = x.view(np.float32) * 127.5
+		iq += 127.5
+		np.clip(iq, 0, 255, out=iq)
+		# round like the ADC, astype alone truncates and biases every sample down half a code
+		np.rint(iq, out=iq)
+
+		raw = bytearray(iq.astype(np.uint8).tobytes())
+
+		if self.realtime:
+			# block for as long as the dongle would to deliver n samples
+			remaining = n / self.sample_rate - (time.perf_counter() - start)
+			if remaining > 0:
+				time.sleep(remaining)
+
+		return raw
+
+	def read_bytes_async(self, callback, num_bytes=1024, context=None):
+		"""
+		Calls callback(bytes, context) with num_bytes blocks until
+		cancel_read_async, like RtlSdr.read_bytes_async
+		"""
+
+		self._streaming = True
+		while self._streaming:
+			callback(self.read_bytes(num_bytes), context or self)
+
+	def cancel_read_async(self):
+		self._streaming = False
+
+	def read_samples(self, num_samples):
+		"""
+		Returns num_samples complex samples, like RtlSdr.read_samples
+		"""
+
+		raw = np.frombuffer(self.read_bytes(int(num_samples) * 2), dtype=np.uint8)
+		iq = (raw.astype(np.float32) - 127.5) / 127.5
+
+		return iq.view(np.complex64).astype(np.complex128)
+
+
+class SyntheticSdr(SimSdr):
+	"""
+	Tones in complex white noise
+
+	signals is a list of (frequency Hz, power dBFS), a tone shows up when
+	it's within the tuned sample rate. Each tone keeps its phase across reads
+	"""
+
+	def __init__(self, signals=(), noise_db=-45.0, **kwargs):
+		super().__init__(**kwargs)
+
+		self.signals = [(float(freq), float(power)) for freq, power in signals]
+		self.noise_db = noise_db
+
+		self._sample = 0
+
+	def _generate(self, n):
+		sigma = np.float32(10 ** (self.noise_db / 20) / np.sqrt(2))
+		x = self.rng.standard_normal(2 * n, dtype=np.float32).view(np.complex64)
+		x *= sigma
+
+		t = np.arange(self._sample, self._sample + n, dtype=np.float64) / self.sample_rate
+		self._sample += n
+
+		for freq, power in self.signals:
+			offset = freq - self.center_freq
+			if abs(offset) < self.sample_rate / 2:
+				x += (10 ** (power / 20) * np.exp(2j * np.pi * offset * t)).astype(np.complex64)
+
+		return x
+
+
+class FileSdr(SimSdr):
+	"""
+	Replays a uint8 IQ recording, looping at the end
+
+	file_freq is the frequency the file was recorded at. While the tuning
+	stays within the recording's span the replay is shifted to match,
+	outside it only noise at noise_db comes back. Without file_freq the
+	recording plays wherever the device is tuned. The file is played at its
+	own rate whatever sample_rate is set to
+	"""
+
+	def __init__(self, path, file_freq=None, file_rate=None, noise_db=-45.0, **kwargs):
+		super().__init__(**kwargs)
+
+		self.path = path
+		self.data = np.memmap(path, dtype=np.uint8, mode="r")
+		if len(self.data) < 2:
+			raise ValueError(f"IQ file is empty: {path}")
+
+		self.file_freq = float(file_freq) if file_freq else None
+		self.file_rate = float(file_rate) if file_rate else self.sample_rate
+		self.noise_db = noise_db
+
+		self._pos = 0
+
+	def _take(self, num_bytes):
+		# contiguous bytes from the memory map, wrapping to the start
+		num_bytes -= num_bytes % 2
+		out = np.empty(num_bytes, dtype=np.uint8)
+
+		filled = 0
+		while filled < num_bytes:
+			chunk = min(num_bytes - filled, len(self.data) - self._pos)
+			chunk -= chunk % 2
+			out[filled:filled + chunk] = self.data[self._pos:self._pos + chunk]
+			filled += chunk
+			self._pos += chunk
+			if self._pos >= len(self.data) - 1:
+				self._pos = 0
+
+		return out
+
+	def _offset(self):
+		return 0.0 if self.file_freq is None else self.file_freq - self.center_freq
+
+	def _generate(self, n):
+		offset = self._offset()
+
+		if abs(offset) >= self.file_rate / 2:
+			sigma = np.float32(10 ** (self.noise_db / 20) / np.sqrt(2))
+			return (self.rng.standard_normal(2 * n, dtype=np.float32) * sigma).view(np.complex64)
+
+		iq = (self._take(n * 2).astype(np.float32) - 127.5) / 127.5
+		x = iq.view(np.complex64)
+
+		if offset:
+			t = np.arange(self._since_tune, self._since_tune + n, dtype=np.float64) / self.file_rate
+			x *= np.exp(2j * np.pi * offset * t).astype(np.complex64)
+
+		return x
+
+	def read_bytes(self, num_bytes):
+		settle_samps = int(self.settle_time * self.sample_rate)
+
+		# in tune and settled, the recording goes out untouched
+		if not self._offset() and self._since_tune >= settle_samps:
+			raw = self._take(num_bytes)
+			self._since_tune += len(raw) // 2
+
+			if self.realtime:
+				time.sleep(len(raw) / 2 / self.sample_rate)
+
+			return bytearray(raw.tobytes())
+
+		return super().read_bytes(num_bytes)
+
+
+def _parse_signals(text):
+	# "915e6/-30,433.92e6/-40" -> [(915e6, -30), (433.92e6, -40)]
+	signals = []
+	for item in filter(None, text.split(",")):
+		freq, _, power = item.partition("/")
+		signals.append((float(freq), float(power or -30)))
+
+	return signals
+
+
+def is_simulated(spec):
+	"""
+	True if an SDR_DEVICE spec names a simulated device
+	"""
+
+	return bool(spec) and spec != "rtl"
+
+
+def open_device(spec, sample_rate, device_id=0, realtime=None):
+	"""
+	Returns the simulated device for spec, or None for a real RTL-SDR
+
+	spec is "rtl" (or empty), "sim[:freq/dB,freq/dB,...]" for SyntheticSdr
+	or "file:path[,file_freq[,file_rate]]" for FileSdr. realtime paces reads
+	to the sample rate, SDR_REALTIME=1 sets it when not given
+	"""
+
+	if not is_simulated(spec):
+		return None
+
+	if realtime is None:
+		realtime = os.getenv('SDR_REALTIME') == "1"
+
+	kind, _, args = spec.partition(":")
+
+	if kind == "sim":
+		return SyntheticSdr(signals=_parse_signals(args), sample_rate=sample_rate, realtime=realtime, seed=int(device_id))
+
+	if kind == "file":
+		path, *rest = args.split(",")
+		file_freq = float(rest[0]) if len(rest) > 0 else None
+		file_rate = float(rest[1]) if len(rest) > 1 else None
+		return FileSdr(path, file_freq=file_freq, file_rate=file_rate, sample_rate=sample_rate, realtime=realtime)
+
+	raise ValueError(f"unknown SDR_DEVICE: {spec}")
+
+
+def main():
+	"""
+	librtlsdr-2freq rtl_sdr stand-in, n samples at -f then n samples at -h to stdout
+	"""
+
+	# -h is the second frequency, as in rtl_sdr
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument("-f", type=float, required=True)
+	parser.add_argument("-h", type=float, required=True)
+	parser.add_argument("-d", default="0")
+	parser.add_argument("-s", type=float, default=2.048e6)
+	parser.add_argument("-g", type=float, default=None)
+	parser.add_argument("-p", type=float, default=None)
+	parser.add_argument("-n", type=float, required=True)
+	parser.add_argument("output")
+
+	args = parser.parse_args()
+
+	sdr = open_device(os.getenv('SDR_DEVICE') or "sim", args.s, device_id=args.d)
+	if sdr is None:
+		sys.exit("sim_sdr.py needs SDR_DEVICE set to a simulated device")
+
+	out = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+
+	block = 1 << 18
+	for freq in (args.f, args.h):
+		sdr.center_freq = freq
+
+		remaining = int(args.n)
+		while remaining > 0:
+			n = min(block, remaining)
+			out.write(sdr.read_bytes(n * 2))
+			remaining -= n
+
+	out.flush()
+
+
+if __name__ == "__main__":
+	main()
@@ -19,6 +19,7 @@ class SignalingClient:
 		self.start_scan_callback = None
 		self.tdoa_settings_callback = None
 		self.scan_settings_callback = None
+		self.calibrate_callback = None
 
 		self.data_channel_callback = None
 
@@ -71,6 +72,16 @@ class SignalingClient:
 				print(f"[!] ERROR CHANGING SCAN SETTINGS: {str(e)}")
 
 
+		@self.sio.on('calibrate', namespace='/nodes')
+		async def calibrate(data=None):
+			print("[*] Got calibrate")
+			try:
+				if self.calibrate_callback:
+					await self.calibrate_callback(data)
+			except Exception as e:
+				print(f"[!] ERROR CALIBRATING: {str(e)}")
+
+
 		@self.sio.on('startScan', namespace='/nodes')
 		async def start_scan():
 			print("[SignalingClient] Start Scan")
@@ -116,15 +127,16 @@ class SignalingClient:
 		async def set_trigger_settings(data):
 			print("[*] Changing Trigger Settings")
 			if data and self.SDR_HANDLER:
-				self.SDR_HANDLER.trigger_db = data['dbLevel']
-				self.SDR_HANDLER.trigger_bw = data['bandwidth']
-				self.SDR_HANDLER.target_freq = data['targetFrequency']
+				self.SDR_HANDLER.set_trigger_settings(data)
 
 
 		@self.sio.on('activateTrigger', namespace='/nodes')
 		async def activate_trigger(data):
 			print("[*] Activating Trigger")
 			if data and self.SDR_HANDLER:
+				# activateTrigger can carry the trigger list itself
+				if isinstance(data, dict) and (data.get('triggers') or data.get('targetFrequency')):
+					self.SDR_HANDLER.set_trigger_settings(data)
 				self.SDR_HANDLER.trigger_active = True
 
 
@@ -0,0 +1,189 @@
+import numpy as np
+from scipy.fft import next_fast_len
+
+import dsp_handler as DSP
+from fft_backend import get_backend
+
+
+# sample rate librtlsdr-2freq's rtl_sdr captures at
+CAPTURE_RATE = 2.048e6
+
+REQUANT_DTYPES = {
+	8: np.int8,
+	16: np.int16,
+}
+
+
+class TDOAReducer:
+	"""
+	Shrinks a librtlsdr-2freq capture before it's uploaded
+
+	The capture alternates segments of segment_samps samples between the
+	reference (even segments) and the target (odd segments). Each segment
+	is channelized down to the bandwidth of its signal and requantized to
+	interleaved int8 or int16 IQ with its own scale, so the upload only
+	carries the band that matters for correlation
+	"""
+
+	def __init__(self, ref_bandwidth=200e3, target_bandwidth=200e3, bits=8, sample_rate=CAPTURE_RATE):
+		if bits not in REQUANT_DTYPES:
+			raise ValueError(f"unsupported TDOA bits: {bits}")
+
+		self.ref_bandwidth = float(ref_bandwidth)
+		self.target_bandwidth = float(target_bandwidth)
+		self.bits = bits
+		self.sample_rate = float(sample_rate)
+
+		self.dtype = np.dtype(REQUANT_DTYPES[bits])
+		self.code_max = np.iinfo(self.dtype).max
+
+	def requantize(self, x):
+		"""
+		Returns (interleaved integer IQ, scale), x ~= codes / scale
+		"""
+
+		iq = x.view(np.float32)
+
+		peak = float(np.max(np.abs(iq))) if len(iq) else 0.0
+		scale = self.code_max / peak if peak > 0 else 1.0
+
+		iq = iq * np.float32(scale)
+		np.rint(iq, out=iq)
+
+		return iq.astype(self.dtype), scale
+
+	def reduce_segment(self, raw, index, freq):
+		"""
+		Reduces one segment of raw uint8 IQ captured at freq
+
+		Returns (metadata dict, bytes)
+		"""
+
+		role = "reference" if index % 2 == 0 else "target"
+		bandwidth = self.ref_bandwidth if role == "reference" else self.target_bandwidth
+
+		x = DSP.iq_to_complex(raw)
+		x -= np.mean(x)
+
+		x, out_rate = DSP.channelize(x, self.sample_rate, 0, bandwidth)
+		codes, scale = self.requantize(x)
+
+		meta = {
+			"segment": index,
+			"role": role,
+			"freq": float(freq),
+			"bandwidth": bandwidth,
+			"sample_rate": out_rate,
+			"decimation": int(round(self.sample_rate / out_rate)),
+			"samples": len(x),
+			"format": f"int{self.bits}",
+			"scale": scale,
+		}
+
+		return meta, codes.tobytes()
+
+
+class TDOACorrelator:
+	"""
+	Cross-correlates the reference and target segments of a capture on the node
+
+	Both segments are channelized to bandwidth, then correlated with one
+	zero-padded FFT. Only the peak lag (parabolic sub-sample fit), its
+	quality and window lags either side of the peak are kept, so the
+	upload is a few hundred bytes instead of the IQ
+	"""
+
+	def __init__(self, bandwidth=200e3, window=16, sample_rate=CAPTURE_RATE):
+		self.bandwidth = float(bandwidth)
+		self.window = int(window)
+		self.sample_rate = float(sample_rate)
+
+	def _prepare(self, raw):
+		x = DSP.iq_to_complex(raw)
+		x -= np.mean(x)
+
+		return DSP.channelize(x, self.sample_rate, 0, self.bandwidth)
+
+	def correlate(self, ref, target, rate):
+		"""
+		Correlates two complex segments sampled at rate
+
+		A positive lag means the target lags the reference. Returns the
+		result dict, window is the normalized correlation magnitude from
+		window_start to window_start + 2 * window as float32 bytes
+		"""
+
+		backend = get_backend()
+
+		nfft = next_fast_len(len(ref) + len(target) - 1)
+
+		ref_f = backend.fft(np.pad(ref, (0, nfft - len(ref))))
+		target_f = backend.fft(np.pad(target, (0, nfft - len(target))))
+
+		# ifft(X) = conj(fft(conj(X))) / nfft, the backends only do forward transforms
+		target_f *= np.conj(ref_f)
+		np.conjugate(target_f, out=target_f)
+		mag = np.abs(backend.fft(target_f))
+
+		# unit peak for identical signals, nfft is the inverse transform's scaling
+		norm = nfft * np.sqrt(np.vdot(ref, ref).real * np.vdot(target, target).real)
+		if norm > 0:
+			mag /= norm
+
+		peak = int(np.argmax(mag))
+
+		# parabolic fit through the peak and its neighbours, circularly
+		left = mag[peak - 1]
+		center = mag[peak]
+		right = mag[(peak + 1) % nfft]
+		denom = left - 2 * center + right
+		frac = 0.5 * (left - right) / denom if denom else 0.0
+
+		# indices past the target's length are negative lags
+		lag = peak if peak < len(target) else peak - nfft
+		lag += frac
+
+		indices = np.arange(peak - self.window, peak + self.window + 1) % nfft
+		window = mag[indices].astype(np.float32)
+
+		# peak against the median of the whole correlation
+		floor = float(np.median(mag))
+
+		return {
+			"lag": float(lag),
+			"lag_seconds": float(lag / rate),
+			"sample_rate": rate,
+			"coefficient": float(center),
+			"snr": float(10 * np.log10(center / floor)) if floor > 0 and center > 0 else 0.0,
+			"window_start": int(round(lag - frac)) - self.window,
+			"window": window.tobytes(),
+		}
+
+	def process(self, capture, segment_samps, freq1, freq2):
+		"""
+		Correlates each (reference, target) segment pair of a raw capture
+
+		Returns a list of result dicts, one per pair
+		"""
+
+		segment_bytes = int(segment_samps) * 2
+		num_segments = len(capture) // segment_bytes
+
+		results = []
+
+		for index in range(0, num_segments - 1, 2):
+			ref, rate = self._prepare(capture[index * segment_bytes:(index + 1) * segment_bytes])
+			target, _ = self._prepare(capture[(index + 1) * segment_bytes:(index + 2) * segment_bytes])
+
+			result = self.correlate(ref, target, rate)
+			result.update({
+				"segment": index,
+				"ref_freq": float(freq1),
+				"target_freq": float(freq2),
+				"bandwidth": self.bandwidth,
+				# the target segment starts this long after the reference one
+				"segment_offset": segment_samps / self.sample_rate,
+			})
+			results.append(result)
+
+		return results
@@ -4,6 +4,8 @@ import aiortc
 from aiortc import RTCPeerConnection, RTCSessionDescription, RTCIceCandidate, RTCDataChannel, RTCConfiguration, RTCIceServer, RTCIceGatherer
 from aiortc.contrib.signaling import object_from_string, object_to_string
 
+import metrics
+
 
 
 class WebRTCClient:
@@ -41,11 +43,23 @@ class WebRTCClient:
 
 
 	async def send_data(self, data):
+		"""
+		Sends data on the data channel, returns False if it was dropped
+		"""
+
 		if self.data_channel and self.data_channel_open:
 			try:
-				self.data_channel.send(data)
+				with metrics.stage("rtc_send"):
+					self.data_channel.send(data)
+				metrics.BYTES_SENT.inc(len(data), "rtc")
+				return True
 			except Exception as e:
+				metrics.DROPPED_FRAMES.inc()
 				print(f"[!] data channel error: {e}")
+		else:
+			metrics.DROPPED_FRAMES.inc()
+
+		return False
 
 
 